@@ -1,9 +1,8 @@
-import logging
 import time
 import asyncio
+import events
 import util
 
-logging.basicConfig(level=logging.DEBUG)
 
 SIMULATE_DELAY = False
 
@@ -24,18 +23,32 @@ class MockBackend:
     '''
 
     last_request = None
+    last_cancelled = None
     last_mod = time.time()
 
     async def request_temperature_data(self, start_time, end_time, resolution):
         start = time.time()
         n_datapoints = util.num_datapoints(end_time - start_time, resolution)
         await asyncio.sleep(int(SIMULATE_DELAY))
-        logging.debug(
-            '''request_temperature_data: Took %s seconds to request %s datapoints''',
-            time.time() - start, n_datapoints)
+        if events.sampled():
+            events.log('backend_request', start=start_time, end=end_time,
+                       resolution=resolution, datapoints=n_datapoints,
+                       seconds=round(time.time() - start, 6))
         self.last_request = (
             start_time,
             end_time,
             resolution
         )
         self.last_mod = time.time()
+
+    def cancel_temperature_data(self, start_time, end_time, resolution):
+        '''The controller no longer needs the data of an earlier request; the call back for it
+        may not come.
+        '''
+        if events.sampled():
+            events.log('backend_cancel', start=start_time, end=end_time, resolution=resolution)
+        self.last_cancelled = (
+            start_time,
+            end_time,
+            resolution
+        )
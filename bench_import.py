@@ -0,0 +1,23 @@
+'''Import time of the package's modules, each in a fresh interpreter, best of a few runs:
+
+    python bench_import.py [runs]
+'''
+import subprocess
+import sys
+
+MODULES = ['controller', 'chart_cache', 'util', 'render', 'prefetch', 'store', 'backend', 'ui']
+
+
+def import_seconds(module):
+    '''Seconds it takes a fresh interpreter to import module, minus the interpreter start'''
+    timer = 'import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', timer.format(module)],
+                            capture_output=True, text=True, check=True).stdout
+    return float(output)
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for module in MODULES:
+        best = min(import_seconds(module) for _ in range(runs))
+        print(f'{module:12} {best * 1000:8.1f} ms')
@@ -1,26 +1,142 @@
+import bisect
+import collections
+import events
+import heapq
 import intervaltree
 import util
 import numpy as np
-import pandas as pd
-import datetime
 import pprint
+import sys
+import zipfile
 
 
-OFFSET = datetime.timedelta(minutes=1)
+# merge doesn't combine adjacent periods beyond this many datapoints (a week at 1 minute), so
+# that merging next to a long period doesn't copy all of it
+MAX_SEGMENT_DATAPOINTS = 7 * 24 * 60
+# what happens to the periods evicted from a cache over its budget: dropped, or first rolled
+# up to 5 minutes, then to 1 hour and only dropped after that
+EVICT_DROP = 'drop'
+EVICT_DOWNSAMPLE = 'downsample'
+# resolutions ChartCache keeps derived levels for, and how many seconds one block of each covers
+# (util imports this module, so its constants can't be used here)
+ROLLUP_BLOCK_SECONDS = {
+    300: 24 * 3600,
+    3600: 7 * 24 * 3600,
+}
 
 
 class IntervalData:
+    '''A run of regularly spaced datapoints. Only the epoch of the first datapoint, the
+    resolution and the values (a contiguous float64 array, NaN for missing) are kept;
+    timestamps of the datapoints are implied by their offsets into the array.
 
-    def __init__(self, resolution, start_time, end_time, dataframe):
+    end is the (exclusive) epoch time the segment covers up to, which can fall inside
+    the last datapoint when the segment has been sliced at an unaligned point.
+    last_access is the cache's clock when the segment was last read or written.
+    '''
+
+    __slots__ = ('resolution', 'start', 'end', 'values', 'last_access')
+
+    def __init__(self, resolution, start_time, end_time, data):
         self.resolution = resolution
-        self.start_time = start_time
-        self.end_time = end_time
-        self.dataframe = dataframe
+        self.start = util.epoch(start_time)
+        self.end = util.epoch(end_time)
+        # there are no DataFrames unless pandas got imported
+        pandas = sys.modules.get('pandas')
+        if pandas is not None and isinstance(data, pandas.DataFrame):
+            data = data['temperature'].to_numpy()
+        self.values = np.asarray(data, dtype=np.float64)
+        self.last_access = 0
+
+    @property
+    def start_time(self):
+        return util.time_stamp(self.start)
+
+    @property
+    def end_time(self):
+        return util.time_stamp(self.end)
+
+    @property
+    def dataframe(self):
+        '''The segment as a DatetimeIndex-ed DataFrame, built on demand; not used by the cache
+        itself'''
+        import pandas as pd
+        dates = pd.date_range(
+            self.start_time, periods=len(self.values), freq=pd.offsets.Second(self.resolution))
+        return pd.DataFrame(self.values, index=dates, columns=['temperature'])
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def offset(self, t):
+        '''Index of the first datapoint at or after epoch time t'''
+        return -((self.start - t) // self.resolution)
+
+    def window(self, start, end):
+        '''Datapoints whose timestamps are in [start, end), as a view into values'''
+        return self.values[max(self.offset(start), 0):max(self.offset(end), 0)]
+
+    def clip(self, start, end):
+        '''The part of the segment covering [start, end). The values are copied, so the part
+        doesn't keep the whole array alive.'''
+        first = (start - self.start) // self.resolution
+        part = IntervalData(self.resolution, self.start + first * self.resolution, end,
+                            self.values[first:self.offset(end)].copy())
+        part.last_access = self.last_access
+        return part
+
+    def split(self, point):
+        '''Split at epoch time point into a lower and an upper segment. A datapoint
+        straddling point is kept by both sides.'''
+        return self.clip(self.start, point), self.clip(point, self.end)
+
+    def rolled_up(self, resolution):
+        '''The segment at the coarser resolution, every datapoint the mean of ours falling into
+        it (as util.scaled_data), aligned to epoch multiples of resolution'''
+        start = self.start // resolution * resolution
+        n_datapoints = -(-(self.end - start) // resolution)
+        total = np.zeros(n_datapoints)
+        count = np.zeros(n_datapoints)
+        self.accumulate(self.start, self.end, start, resolution, total, count)
+        with np.errstate(invalid='ignore'):
+            coarser = IntervalData(resolution, start, self.end, total / count)
+        coarser.last_access = self.last_access
+        return coarser
+
+    def accumulate(self, start, end, out_start, out_resolution, total, count):
+        '''Add the datapoints covering [start, end) into the total and count buffers, whose
+        index 0 is out_start and spacing out_resolution. Missing values are skipped.
+        '''
+        if self.resolution <= out_resolution:
+            # every datapoint of ours falls into exactly one output bucket (same or rolled up)
+            lo = max(self.offset(start), 0)
+            values = self.values[lo:max(self.offset(end), 0)]
+            times = self.start + (lo + np.arange(len(values))) * self.resolution
+            idx = (times - out_start) // out_resolution
+        else:
+            # extrapolate: every output bucket takes the datapoint it falls into
+            j0 = -((out_start - start) // out_resolution)
+            j1 = -((out_start - end) // out_resolution)
+            idx = np.arange(max(j0, 0), min(j1, len(total)))
+            src = (out_start + idx * out_resolution - self.start) // self.resolution
+            inside = (src >= 0) & (src < len(self.values))
+            idx = idx[inside]
+            values = self.values[src[inside]]
+        present = ~np.isnan(values)
+        idx = idx[present]
+        if not len(idx):
+            return
+        # idx is sorted, so only the touched span of the buffers needs counting
+        first = idx[0]
+        sums = np.bincount(idx - first, weights=values[present])
+        total[first:first + len(sums)] += sums
+        count[first:first + len(sums)] += np.bincount(idx - first)
 
     def __eq__(self, other):
         return (self.resolution == other.resolution
-                and self.start_time == other.start_time
-                and self.end_time == other.end_time)
+                and self.start == other.start
+                and self.end == other.end)
 
 
     def __repr__(self):
@@ -30,18 +146,688 @@ class IntervalData:
         '{self.start_time}',
         '{self.end_time}',
 
-        {self.dataframe.describe()})'''
+        {len(self.values)} datapoints)'''
 
 
-class ChartCache(intervaltree.IntervalTree):
+def period_data_combinator(data_earlier, data_later):
+    ''' Combine the data of two periods of the same resolution that are adjacent to each other
+    '''
+    assert data_earlier.resolution == data_later.resolution
+
+    # a datapoint straddling the boundary is in both periods, only keep it once
+    offset = (data_later.start - data_earlier.start) // data_earlier.resolution
+    gap = max(offset - len(data_earlier.values), 0)
+    combined = IntervalData(
+        data_earlier.resolution, data_earlier.start, data_later.end,
+        np.concatenate([
+            data_earlier.values[:offset], np.full(gap, np.nan), data_later.values]))
+    combined.last_access = max(data_earlier.last_access, data_later.last_access)
+    return combined
+
+
+class RollupLevel:
+    '''Sum and count per bucket of every datapoint in the cache that is finer than
+    resolution, so that a get at resolution is a slice rather than an aggregation. Buckets are
+    stored in fixed size blocks, keyed by block number.
+    '''
+
+    __slots__ = ('resolution', 'block_size', 'blocks', 'nbytes')
+
+    def __init__(self, resolution, block_seconds):
+        self.resolution = resolution
+        self.block_size = block_seconds // resolution
+        # block number -> 2 x block_size array of sums and counts
+        self.blocks = {}
+        # bytes of the blocks, kept as they are added and deleted
+        self.nbytes = 0
+
+    def _spans(self, start, end):
+        '''(block, first bucket, last bucket exclusive, buffer offset) for every block
+        overlapping [start, end); start and end are aligned to resolution'''
+        first = start // self.resolution
+        last = end // self.resolution
+        block = first // self.block_size
+        while block * self.block_size < last:
+            block_first = block * self.block_size
+            lo = max(first, block_first)
+            hi = min(last, block_first + self.block_size)
+            yield block, lo - block_first, hi - block_first, lo - first
+            block += 1
+
+    def write(self, start, total, count):
+        '''Overwrite the buckets from start on with total and count'''
+        end = start + len(total) * self.resolution
+        for b, lo, hi, off in self._spans(start, end):
+            block = self.blocks.get(b)
+            if block is None:
+                block = self.blocks[b] = np.zeros((2, self.block_size))
+                self.nbytes += block.nbytes
+            block[0, lo:hi] = total[off:off + hi - lo]
+            block[1, lo:hi] = count[off:off + hi - lo]
+            if not block[1].any():
+                del self.blocks[b]
+                self.nbytes -= block.nbytes
+
+    def restore(self, numbers, blocks):
+        '''Put back the blocks, with their block numbers, of a level saved with save()'''
+        for number, block in zip(numbers, blocks):
+            self.blocks[int(number)] = block
+            self.nbytes += block.nbytes
+
+    def read(self, start, end, total, count):
+        '''Add the buckets in [start, end) into total and count'''
+        for b, lo, hi, off in self._spans(start, end):
+            block = self.blocks.get(b)
+            if block is not None:
+                total[off:off + hi - lo] += block[0, lo:hi]
+                count[off:off + hi - lo] += block[1, lo:hi]
+
+
+# a cached period, begin and end in epoch time
+Period = collections.namedtuple('Period', ['begin', 'end', 'data'])
+
+
+class CacheOperations:
     '''
     1) (Find ones needed to be udpated)
     Given start, end time and resolution, find all intevals that either
     don't exist in cache or exist in cache but of lower resolution than
     resolution
     2) Merge new data in; keep the highest resolution
+    3) Keep rolled up levels (see RollupLevel) of the data finer than 5 minutes and 1 hour
+
+    Shared by the cache engines, which store disjoint periods and provide
+    periods(start, end) - the Periods overlapping [start, end), sorted
+    replace_periods(old, new) - swap a sorted run of Periods returned by periods() for the
+    sorted (begin, end, data) in new, covering the same span
+    all_periods() - every Period, sorted
+    and call _period_added / _period_removed for every period they add or remove.
+
+    With max_bytes, the least recently accessed periods are evicted once the cache (periods
+    and rollup levels) is over max_bytes, except for the ones overlapping the viewport given
+    to pin(). evict_policy says whether evicted periods are dropped (EVICT_DROP) or rolled up
+    to the coarser resolutions first (EVICT_DOWNSAMPLE).
+
+    With a store (see store.MmapStore), every merge is written through to it, or without
+    write_through, evicted periods are spilled to it instead of being lost. The parts of a
+    range the cache is missing are read from it before a get or a plan, unless it's given
+    read_through=False; stored(), read_stored() and merge_stored() do the same in steps, so the
+    reading can be done off the event loop.
     '''
 
+    def _init_cache(self, max_bytes, evict_policy, store=None, write_through=True):
+        self.rollups = {
+            resolution: RollupLevel(resolution, block_seconds)
+            for resolution, block_seconds in ROLLUP_BLOCK_SECONDS.items()
+        }
+        # (begin, end) of periods added or removed since the levels were last refreshed
+        self._rollups_dirty = []
+        self._mark_rollups = True
+        self.max_bytes = max_bytes
+        self.evict_policy = evict_policy
+        # resolution -> bytes of the periods at that resolution
+        self._period_nbytes = collections.Counter()
+        # incremented on every get and merge, periods touched record it as their last_access
+        self._clock = 0
+        # (last_access, begin) of the periods, oldest first; an entry is stale once the period
+        # at begin is gone or has been accessed since, and is dropped when it comes up
+        self._recency = []
+        # begin -> Period, of every period
+        self._by_begin = {}
+        self._viewport = None
+        self.store = store
+        self.write_through = write_through
+
+    def _period_added(self, begin, end, data):
+        self._period_nbytes[data.resolution] += data.nbytes
+        self._by_begin[begin] = Period(begin, end, data)
+        self._push_recency(data.last_access, begin)
+        self._mark_rollups_dirty(begin, end, data)
+
+    def _period_removed(self, begin, end, data):
+        self._period_nbytes[data.resolution] -= data.nbytes
+        if begin in self._by_begin and self._by_begin[begin].data is data:
+            del self._by_begin[begin]
+        self._mark_rollups_dirty(begin, end, data)
+
+    def _accessed(self, periods):
+        '''Record periods as accessed now'''
+        self._clock += 1
+        for p in periods:
+            p.data.last_access = self._clock
+            self._push_recency(self._clock, p.begin)
+
+    def _push_recency(self, last_access, begin):
+        heapq.heappush(self._recency, (last_access, begin))
+        if len(self._recency) > 2 * len(self._by_begin) + 64:
+            # mostly stale entries, rebuilt from the live periods
+            self._recency = [(p.data.last_access, p.begin) for p in self._by_begin.values()]
+            heapq.heapify(self._recency)
+
+    def _least_recent(self):
+        '''Pop the least recently accessed period off the recency heap, None once it's empty'''
+        while self._recency:
+            last_access, begin = heapq.heappop(self._recency)
+            p = self._by_begin.get(begin)
+            if p is not None and p.data.last_access == last_access:
+                return p
+        return None
+
+    def _mark_rollups_dirty(self, begin, end, data):
+        if self._mark_rollups and data.resolution < max(self.rollups):
+            self._rollups_dirty.append((begin, end))
+
+    def pin(self, start_time, end_time):
+        '''Periods overlapping [start_time, end_time) won't be evicted'''
+        self._viewport = (util.epoch(start_time), util.epoch(end_time))
+
+    @property
+    def nbytes(self):
+        return (sum(self._period_nbytes.values())
+                + sum(level.nbytes for level in self.rollups.values()))
+
+    def nbytes_by_resolution(self):
+        '''resolution -> bytes used by the periods stored at that resolution plus the rollup
+        level of that resolution'''
+        usage = {resolution: nbytes for resolution, nbytes in self._period_nbytes.items()
+                 if nbytes}
+        for resolution, level in self.rollups.items():
+            if level.nbytes:
+                usage[resolution] = usage.get(resolution, 0) + level.nbytes
+        return usage
+
+    def evict(self):
+        '''Evict the least recently accessed periods until the cache is within max_bytes.
+        When downsampling, every cold period is rolled up to 5 minutes before any is rolled up
+        to 1 hour, and every one to 1 hour before any is dropped.
+        '''
+        if self.max_bytes is None or self.nbytes <= self.max_bytes:
+            return
+        if self.evict_policy == EVICT_DOWNSAMPLE:
+            # resolution to roll up to, None for dropping
+            stages = sorted(self.rollups) + [None]
+        else:
+            stages = [None]
+        evicted = 0
+        for coarser in stages:
+            over = self.nbytes - self.max_bytes
+            if over <= 0:
+                break
+            # periods passed over in this stage, back on the heap after it
+            kept = []
+            while over > 0:
+                p = self._least_recent()
+                if p is None:
+                    break
+                if self._viewport and (p.end > self._viewport[0]
+                                       and p.begin < self._viewport[1]):
+                    kept.append(p)
+                elif coarser is None:
+                    self._spill(p)
+                    self.replace_periods([p], [])
+                    over -= p.data.nbytes
+                    evicted += 1
+                elif p.data.resolution < coarser:
+                    self._spill(p)
+                    rolled_up = p.data.rolled_up(coarser)
+                    self.replace_periods([p], [(p.begin, p.end, rolled_up)])
+                    over -= p.data.nbytes - rolled_up.nbytes
+                    evicted += 1
+                else:
+                    kept.append(p)
+            for p in kept:
+                self._push_recency(p.data.last_access, p.begin)
+            self.refresh_rollups()
+        if events.sampled():
+            events.log('evict', periods=evicted, nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+    def _spill(self, period):
+        '''Keep the data of a period about to be evicted in the store, unless it's already there
+        from the merge'''
+        if self.store is not None and not self.write_through:
+            self.store.write(period.data.start, period.data.end, period.data.resolution,
+                             period.data.values)
+
+    def refresh_rollups(self):
+        '''Recompute the buckets of the rolled up levels that periods added or removed since
+        the last refresh fall into'''
+        if not self._rollups_dirty:
+            return
+        spans = sorted(self._rollups_dirty)
+        self._rollups_dirty = []
+        for resolution, level in self.rollups.items():
+            # dirty spans, aligned to the level's buckets and coalesced
+            aligned = []
+            for begin, end in spans:
+                begin = begin // resolution * resolution
+                end = -(-end // resolution) * resolution
+                if aligned and begin <= aligned[-1][1]:
+                    aligned[-1][1] = max(aligned[-1][1], end)
+                else:
+                    aligned.append([begin, end])
+            for begin, end in aligned:
+                n_buckets = (end - begin) // resolution
+                total = np.zeros(n_buckets)
+                count = np.zeros(n_buckets)
+                for p in self.periods(begin, end):
+                    if p.data.resolution < resolution:
+                        p.data.accumulate(
+                            max(p.begin, begin), min(p.end, end), begin, resolution, total, count)
+                level.write(begin, total, count)
+
+    def merge(self, start_time, end_time, data_resolution, data):
+        '''Given the start_time, end_time and the resolution of a list, merges into the cache.
+        Only the periods overlapping or adjacent to the new one are touched, so the cost of a
+        merge doesn't depend on the size of the cache.
+        '''
+        start, end = util.epoch(start_time), util.epoch(end_time)
+        new_data = IntervalData(data_resolution, start, end, data)
+        if self.store is not None and self.write_through:
+            self.store.write(start, end, data_resolution, new_data.values)
+        self._merge(start, end, new_data)
+        if events.sampled():
+            events.log('merge', start=start, end=end, resolution=data_resolution,
+                       datapoints=len(new_data.values), nbytes=self.nbytes)
+
+    def _merge(self, start, end, new_data):
+        data_resolution = new_data.resolution
+        hitlist = self.periods(start - 1, end + 1)
+        # (begin, end, data) of what's left of the hit periods, and of the new period where
+        # the cache doesn't already have data of a higher resolution
+        pieces = []
+        cursor = start
+        for begin, stop, iv_data in hitlist:
+            if stop <= start or begin >= end:
+                # adjacent, kept as it is but might get combined below
+                pieces.append((begin, stop, iv_data))
+                continue
+            if begin < start:
+                lower, iv_data = iv_data.split(start)
+                pieces.append((begin, start, lower))
+                begin = start
+            upper = None
+            if stop > end:
+                iv_data, upper = iv_data.split(end)
+                upper = (end, stop, upper)
+                stop = end
+            if iv_data.resolution < data_resolution:
+                if cursor < begin:
+                    pieces.append((cursor, begin, new_data.clip(cursor, begin)))
+                pieces.append((begin, stop, iv_data))
+                cursor = stop
+            if upper:
+                pieces.append(upper)
+        if cursor < end:
+            pieces.append((cursor, end, new_data.clip(cursor, end)))
+        pieces.sort(key=lambda piece: piece[0])
+
+        # combine adjacent pieces of the same resolution
+        combined = [pieces[0]]
+        for begin, stop, piece_data in pieces[1:]:
+            last_begin, last_stop, last_data = combined[-1]
+            if (last_stop == begin and last_data.resolution == piece_data.resolution
+                    and util.num_datapoints(stop - last_begin, piece_data.resolution)
+                    <= MAX_SEGMENT_DATAPOINTS):
+                combined[-1] = (
+                    last_begin, stop, period_data_combinator(last_data, piece_data))
+            else:
+                combined.append((begin, stop, piece_data))
+
+        self._clock += 1
+        for _, _, piece_data in combined:
+            piece_data.last_access = self._clock
+
+        # only data in [start, end) changed, the rest was just cut up or combined
+        self._mark_rollups = False
+        self.replace_periods(hitlist, combined)
+        self._mark_rollups = True
+        self._rollups_dirty.append((start, end))
+        self.refresh_rollups()
+        self.evict()
+
+    def save(self, path):
+        '''Snapshot the periods into the npz file path: a table of the periods, one column
+        per field, and the values of all of them concatenated. The blocks of every rollup level
+        are saved as well, stacked, with their block numbers.'''
+        periods = self.all_periods()
+        rollups = {}
+        for resolution, level in self.rollups.items():
+            numbers = sorted(level.blocks)
+            rollups[f'rollup_{resolution}_blocks'] = np.array(numbers, dtype=np.int64)
+            rollups[f'rollup_{resolution}'] = (
+                np.stack([level.blocks[number] for number in numbers]) if numbers
+                else np.empty((0, 2, level.block_size)))
+        # through a file object, so np.savez doesn't append .npz to path
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                begin=np.array([p.begin for p in periods], dtype=np.int64),
+                end=np.array([p.end for p in periods], dtype=np.int64),
+                resolution=np.array([p.data.resolution for p in periods], dtype=np.int64),
+                start=np.array([p.data.start for p in periods], dtype=np.int64),
+                data_end=np.array([p.data.end for p in periods], dtype=np.int64),
+                length=np.array([len(p.data.values) for p in periods], dtype=np.int64),
+                last_access=np.array([p.data.last_access for p in periods], dtype=np.int64),
+                values=np.concatenate([p.data.values for p in periods] or [np.empty(0)]),
+                **rollups,
+            )
+
+    @classmethod
+    def load(cls, path, mmap=False, **kwargs):
+        '''A cache, made with kwargs, with the periods save() put in the npz file path. With
+        mmap, the values stay in the file, memory-mapped read-only, and are paged in as they
+        are read. The rollup levels are restored as saved, rather than recomputed from the
+        datapoints of every period.
+        '''
+        cache = cls(**kwargs)
+        with np.load(path) as table:
+            columns = {name: table[name] for name in table.files if name != 'values'}
+            values = _mmap_npz_member(path, 'values') if mmap else table['values']
+        offsets = np.concatenate([[0], np.cumsum(columns['length'])])
+        periods = []
+        for i in range(len(columns['begin'])):
+            data = IntervalData(int(columns['resolution'][i]), int(columns['start'][i]),
+                                int(columns['data_end'][i]), values[offsets[i]:offsets[i + 1]])
+            data.last_access = int(columns['last_access'][i])
+            periods.append((int(columns['begin'][i]), int(columns['end'][i]), data))
+        if periods:
+            cache.replace_periods([], periods)
+            cache._clock = max(data.last_access for _, _, data in periods)
+        saved = [(level, f'rollup_{resolution}') for resolution, level in cache.rollups.items()]
+        if all(name in columns and columns[name].shape[1:] == (2, level.block_size)
+               for level, name in saved):
+            cache._rollups_dirty = []
+            for level, name in saved:
+                level.restore(columns[name + '_blocks'], columns[name])
+        cache.refresh_rollups()
+        cache.evict()
+        return cache
+
+    def get(self, start_time, end_time, data_resolution=0, read_through=True):
+        ''' Give start_time and end_time (exclusive), return data unalterd from cache
+        if data is data_resolution. Otherwise, return the rolled up or extrapolated.
+        Datapoints the cache has no data for are None.
+
+        Without data_resolution, the datapoints of every overlapping period are returned in
+        the resolution they are stored in.
+        '''
+        start, end = util.epoch(start_time), util.epoch(end_time)
+        if read_through:
+            self._read_through(start, end, data_resolution)
+
+        # overlapping ones; the end time in period is exclusive
+        periods = self.periods(start, end)
+        self._accessed(periods)
+
+        if not data_resolution:
+            windows = [
+                p.data.window(max(p.begin, start), min(p.end, end))
+                for p in periods
+            ]
+            values = np.concatenate(windows) if windows else np.empty(0)
+            return util.to_list(values)
+
+        out = np.empty(util.num_datapoints(end - start, data_resolution))
+        self._get_into(start, end, data_resolution, periods, out)
+        return util.to_list(out)
+
+    def get_array(self, start_time, end_time, data_resolution=0, read_through=True):
+        '''get as a read-only float array, NaN for missing datapoints. A range inside a
+        single period stored at data_resolution is a view into the period's values, without a
+        copy; merges never write into those, they replace them. Otherwise the datapoints are
+        written into one newly allocated array.
+        '''
+        start, end = util.epoch(start_time), util.epoch(end_time)
+        if read_through:
+            self._read_through(start, end, data_resolution)
+        periods = self.periods(start, end)
+        self._accessed(periods)
+
+        if len(periods) == 1:
+            p = periods[0]
+            resolution = data_resolution or p.data.resolution
+            if (p.data.resolution == resolution and p.begin <= start and end <= p.end
+                    and not (start - p.data.start) % resolution):
+                values = p.data.window(start, end).view()
+                values.flags.writeable = False
+                return values
+
+        if not data_resolution:
+            values = np.concatenate([
+                p.data.window(max(p.begin, start), min(p.end, end)) for p in periods
+            ] or [np.empty(0)])
+        else:
+            values = np.empty(util.num_datapoints(end - start, data_resolution))
+            self._get_into(start, end, data_resolution, periods, values)
+        values.flags.writeable = False
+        return values
+
+    def get_native(self, start_time, end_time, read_through=True):
+        '''The epoch times and values of the datapoints the cache has in [start_time,
+        end_time), at whatever resolution each is stored in, in time order; NaN values are
+        left out'''
+        start, end = util.epoch(start_time), util.epoch(end_time)
+        if read_through:
+            self._read_through(start, end, 0)
+        periods = self.periods(start, end)
+        self._accessed(periods)
+        times, values = [np.empty(0, dtype=np.int64)], [np.empty(0)]
+        for p in periods:
+            first = max(p.data.offset(max(p.begin, start)), 0)
+            window = p.data.window(max(p.begin, start), min(p.end, end))
+            times.append(p.data.start + (first + np.arange(len(window))) * p.data.resolution)
+            values.append(window)
+        times, values = np.concatenate(times), np.concatenate(values)
+        present = ~np.isnan(values)
+        return times[present], values[present]
+
+    def get_into(self, start_time, end_time, data_resolution, out, read_through=True):
+        '''Like get at data_resolution, but writes the datapoints into the float array out,
+        NaN where the cache has no data, instead of building a list'''
+        start, end = util.epoch(start_time), util.epoch(end_time)
+        if read_through:
+            self._read_through(start, end, data_resolution)
+        periods = self.periods(start, end)
+        self._accessed(periods)
+        self._get_into(start, end, data_resolution, periods, out)
+
+    def _get_into(self, start, end, data_resolution, periods, out):
+        total = np.zeros(len(out))
+        count = np.zeros(len(out))
+        level = self.rollups.get(data_resolution)
+        if level is not None and not start % data_resolution and not end % data_resolution:
+            # finer data is already rolled up in the level, only coarser periods are left
+            self.refresh_rollups()
+            level.read(start, end, total, count)
+            periods = [p for p in periods if p.data.resolution >= data_resolution]
+        for p in periods:
+            p.data.accumulate(
+                max(p.begin, start), min(p.end, end), start, data_resolution, total, count)
+        with np.errstate(invalid='ignore'):
+            np.divide(total, count, out=out)
+
+    def intervals_be_updated(self, new_start_time, new_end_time, new_resolution,
+                             read_through=True):
+        ''' Return the list of (start_time, end_time, resolution), in chronological order,
+        that we need to request data from backend for: the parts of the range the cache has
+        no data for and the parts it only has at a lower resolution than new_resolution.
+        Parts covered by data at new_resolution or finer are satisfied. Intervals that need
+        to be requested and cross the boundries of the cache periods get chopped.
+        '''
+        start, end = util.epoch(new_start_time), util.epoch(new_end_time)
+        if read_through:
+            self._read_through(start, end, new_resolution)
+        return self._missing(start, end, new_resolution)
+
+    def _missing(self, start, end, new_resolution):
+        result = []
+        # everything before cursor is accounted for
+        cursor = start
+        for p in self.periods(start, end):
+            begin, stop = max(p.begin, start), min(p.end, end)
+            if cursor < begin:
+                result.append((cursor, begin, new_resolution))
+            if p.data.resolution > new_resolution:
+                result.append((begin, stop, new_resolution))
+            cursor = max(cursor, stop)
+        if cursor < end:
+            result.append((cursor, end, new_resolution))
+
+        return result
+
+
+    def stored(self, start_time, end_time, data_resolution):
+        '''(begin, end, resolution) of what the store has of the parts of [start_time,
+        end_time) the cache is missing at data_resolution: at data_resolution or finer wherever
+        the cache only has coarser data, and at any resolution where it has none; finest first
+        '''
+        if self.store is None:
+            return []
+        start, end = util.epoch(start_time), util.epoch(end_time)
+        coarsest = max(util.VALID_RESOLUTIONS)
+        pieces = []
+        for stored_resolution in self.store.resolutions:
+            plan_resolution = (data_resolution if stored_resolution <= data_resolution
+                               else coarsest)
+            for missing_start, missing_end, _ in self._missing(start, end, plan_resolution):
+                pieces.extend(
+                    (begin, stop, stored_resolution)
+                    for begin, stop in self.store.covered(
+                        missing_start, missing_end, stored_resolution)
+                )
+        return pieces
+
+    def read_stored(self, pieces):
+        '''(begin, end, IntervalData) of the pieces stored() returned, read from the store.
+        Only the store is read, so it can run in another thread while the cache is in use.'''
+        return [
+            (begin, stop, IntervalData(
+                resolution, begin, stop, np.array(self.store.read(begin, stop, resolution))))
+            for begin, stop, resolution in pieces
+        ]
+
+    def merge_stored(self, loaded):
+        '''Merge what read_stored() returned; merging never replaces finer data with coarser,
+        so overlapping pieces of coarser resolutions only fill in around the finer ones'''
+        for begin, stop, data in loaded:
+            self._merge(begin, stop, data)
+
+    def _read_through(self, start, end, data_resolution):
+        pieces = self.stored(start, end, data_resolution)
+        if pieces:
+            self.merge_stored(self.read_stored(pieces))
+
+    def tiles_be_updated(self, new_start_time, new_end_time, new_resolution,
+                         read_through=True):
+        ''' Like intervals_be_updated, but as the keys (see util.tile_keys) of the whole tiles
+        to request'''
+        start, end = util.epoch(new_start_time), util.epoch(new_end_time)
+        return [
+            key for key in util.tile_keys(start, end, new_resolution)
+            if self.intervals_be_updated(*util.tile_range(key), read_through=read_through)
+        ]
+
+    def get_tile(self, key):
+        '''Values of the tile with key, NaN where the cache has no data'''
+        return np.array(self.get(*util.tile_range(key)), dtype=np.float64)
+
+    def merge_tile(self, key, data):
+        start_time, end_time, data_resolution = util.tile_range(key)
+        self.merge(start_time, end_time, data_resolution, data)
+
+
+def _mmap_npz_member(path, name):
+    '''The array name in the uncompressed npz file path, memory-mapped read-only'''
+    with zipfile.ZipFile(path) as archive:
+        header_offset = archive.getinfo(name + '.npy').header_offset
+    with open(path, 'rb') as f:
+        # the zip local file header: 30 bytes, then the file name and extra field
+        f.seek(header_offset + 26)
+        name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+        f.seek(header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                       else np.lib.format.read_array_header_2_0)
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+    if not shape[0]:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def _epoch_keyed(interval):
+    '''The interval with its begin and end in epoch seconds'''
+    if isinstance(interval.begin, int) and isinstance(interval.end, int):
+        return interval
+    return intervaltree.Interval(util.epoch(interval.begin), util.epoch(interval.end),
+                                 interval.data)
+
+
+class ChartCache(CacheOperations, intervaltree.IntervalTree):
+    '''Cache engine storing the periods in an intervaltree.IntervalTree, keyed by epoch
+    seconds. Intervals and points given to the tree's own methods can be pd.Timestamp as well,
+    they are converted on the way in.'''
+
+    def __init__(self, intervals=None, max_bytes=None, evict_policy=EVICT_DROP, store=None,
+                 write_through=True):
+        # intervaltree re-initializes the tree with the same intervals when merging them, the
+        # data doesn't change in that case so the levels and byte counts are kept
+        if not hasattr(self, 'rollups') or intervals is None:
+            self._init_cache(max_bytes, evict_policy, store, write_through)
+            self._tracking = True
+        else:
+            self._tracking = False
+        super().__init__(None if intervals is None else map(_epoch_keyed, intervals))
+        self._tracking = True
+
+    def _add_boundaries(self, interval):
+        super()._add_boundaries(interval)
+        if self._tracking:
+            self._period_added(interval.begin, interval.end, interval.data)
+
+    def _remove_boundaries(self, interval):
+        super()._remove_boundaries(interval)
+        if self._tracking:
+            self._period_removed(interval.begin, interval.end, interval.data)
+
+    def add(self, interval):
+        super().add(_epoch_keyed(interval))
+
+    def remove(self, interval):
+        super().remove(_epoch_keyed(interval))
+
+    def discard(self, interval):
+        super().discard(_epoch_keyed(interval))
+
+    def at(self, p):
+        return super().at(util.epoch(p))
+
+    def overlap(self, begin, end=None):
+        if end is None:
+            return super().overlap(_epoch_keyed(begin))
+        return super().overlap(util.epoch(begin), util.epoch(end))
+
+    def envelop(self, begin, end=None):
+        if end is None:
+            return super().envelop(_epoch_keyed(begin))
+        return super().envelop(util.epoch(begin), util.epoch(end))
+
+    def chop(self, begin, end, datafunc=None):
+        super().chop(util.epoch(begin), util.epoch(end), datafunc)
+
+    def periods(self, start, end):
+        return [Period(*iv) for iv in sorted(super().overlap(start, end))]
+
+    def replace_periods(self, old, new):
+        for begin, end, data in old:
+            super().remove(intervaltree.Interval(begin, end, data))
+        for begin, end, data in new:
+            super().add(intervaltree.Interval(begin, end, data))
+
+    def all_periods(self):
+        return [Period(*iv) for iv in sorted(self)]
+
     def split_overlaps(self):
         """Overridden library's implementation, to slice every boundry instead.
         ====================Original=========================
@@ -76,6 +862,7 @@ class ChartCache(intervaltree.IntervalTree):
         value for the interval's data field
         ======================End Original=============================
         """
+        point = util.epoch(point)
         hitlist = set(iv for iv in self.at(point) if iv.begin < point)
         insertions = set()
         if datafunc:
@@ -83,139 +870,56 @@ class ChartCache(intervaltree.IntervalTree):
                 insertions.add(intervaltree.Interval(iv.begin, point, datafunc(iv, True)))
                 insertions.add(intervaltree.Interval(point, iv.end, datafunc(iv, False)))
         else:
+            # offsets into the segments' arrays; no label based slicing
             for iv in hitlist:
-                insertions.add(
-                    intervaltree.Interval(iv.begin, point,
-                    util.period_data_splitter(iv, True, point)))
-                insertions.add(
-                    intervaltree.Interval(point, iv.end,
-                    util.period_data_splitter(iv, False, point)))
+                lower, upper = iv.data.split(point)
+                insertions.add(intervaltree.Interval(iv.begin, point, lower))
+                insertions.add(intervaltree.Interval(point, iv.end, upper))
         self.difference_update(hitlist)
         self.update(insertions)
 
-    def merge(self, start_time, end_time, data_resolution, data):
-        '''Given the start_time, end_time and the resolution of a list, merges into the cache
-        '''
-        # test left and right side of new_period to see if we can merge with
-        # adjacent periods, only merge if resolutions were the same
-        new_period = util.list_tointerval(start_time, end_time, data_resolution, data)
-        self.add(new_period)
-        self.split_overlaps()
-        self.merge_equals(data_reducer=util.period_data_reducer)
-        overlapped_periods = sorted(self[new_period.begin-OFFSET:new_period.end+OFFSET])
-        for i in range(1, len(overlapped_periods)):
-            if overlapped_periods[i].data.resolution == overlapped_periods[
-                    i - 1].data.resolution:
-                self.add(
-                    intervaltree.Interval(overlapped_periods[i].begin - OFFSET,
-                    overlapped_periods[i].end,
-                             overlapped_periods[i].data))
-                self.remove(overlapped_periods[i])
-        self.merge_overlaps(data_reducer=util.period_data_combinator)
-
-    def get(self, start_time, end_time, data_resolution=0):
-        ''' Give start_time and end_time (exclusive), guranteed being completely envelopped by
-        some intervals in the cache, return data unalterd from cache
-        if data is data_resolution. Otherwise, return the rolled up or extrapolated.
-        '''
-        if isinstance(start_time, int):
-            start_time = util.time_stamp(start_time)
-        if isinstance(end_time, int):
-            end_time = util.time_stamp(end_time)
-
-        # overlapping ones; the end time in period is exclusive
-        periods = sorted(self[start_time:end_time])
-
-        if data_resolution:
-            dfs = []
-            for p in periods:
-                if p.data.resolution < data_resolution:
-                    dfs.append(
-                        p.data.dataframe.groupby(pd.Grouper(freq=f'{data_resolution}S')).mean()
-                    )
-                elif p.data.resolution > data_resolution:
-                    period_resolution = p.data.resolution
-                    period_start_time = p.begin
-                    period_end_time = p.end
-                    # portion of of what we wanted
-                    if period_end_time == end_time:
-                        datalst = p.data.dataframe[start_time:end_time]['temperature'].tolist()
-                    else:
-                        datalst = p.data.dataframe[start_time:end_time][:-1]['temperature'].tolist()
-                    extrapolated_data = util.extrapolated_data(
-                        datalst, int(np.ceil(period_resolution/data_resolution)))
-                    dates_for_extrapolated = pd.date_range(
-                        max(period_start_time, start_time),
-                        min(period_end_time, end_time),
-                        freq=f'{data_resolution}S'
-                    )[:-1]
-                    extrapolated_df = pd.DataFrame(
-                        extrapolated_data,
-                        index=dates_for_extrapolated,
-                        columns=['temperature']
-                    )
-                    dfs.append(extrapolated_df)
-                else:
-                    dfs.append(p.data.dataframe)
-        else:
-            dfs = [p.data.dataframe for p in periods]
-
-        df = pd.concat(dfs)
-        # periods might contain more data than we need, dataframe indexing includes end index, so
-        # we need to remove 1 extra data point should periods has more data than we need.
-        if df.index.max() > end_time:
-            data = df[start_time:end_time][:-1]['temperature']
-        else:
-            data = df[start_time:end_time]['temperature']
-
-        return data.values.tolist()
-
-
-    def intervals_be_updated(self, new_start_time, new_end_time, new_resolution):
-        ''' Provided either start times are equal or end times are equal, return the
-        list of (start_time, end_time, resolution) that we need to request data from backend for
-        , intervals that need to be reuqested and crossing the boundries of the cache periods
-        might get chopped into 2 parts (refactor:)
-        '''
-        if isinstance(new_start_time, int):
-            new_start_time = util.time_stamp(new_start_time)
-        if isinstance(new_end_time, int):
-            new_end_time = util.time_stamp(new_end_time)
-
-        if not self[new_start_time:new_end_time]:
-            return [(util.epoch(new_start_time), util.epoch(new_end_time), new_resolution)]
-
-        # update on the existing cache
-        overlapped = sorted(self[new_start_time:new_end_time])
-        existing_be_updated = [
-                (max(p.begin, new_start_time), min(p.end, new_end_time), new_resolution)
-                for p in overlapped
-                if p.data.resolution > new_resolution
-            ]
-
-        # currently unfilled
-        start_end_times = [(p.begin, p.end) for p in overlapped]
-        overlapped_start_time = min(start_end_times, key=lambda t: t[0])[0]
-        overlapped_end_time = max(start_end_times, key=lambda t: t[1])[1]
-        if new_start_time < overlapped_start_time:
-            non_existing_be_updated_start_time = [(new_start_time, overlapped_start_time, new_resolution)]
-        else:
-            non_existing_be_updated_start_time = []
-        if new_end_time > overlapped_end_time:
-            non_existing_be_updated_end_time = [(overlapped_end_time, new_end_time, new_resolution)]
-        else:
-            non_existing_be_updated_end_time = []
+    def __repr__(self):
+        return pprint.pformat(sorted(self), indent=4)
 
-        result = existing_be_updated + non_existing_be_updated_end_time + non_existing_be_updated_start_time
-        result_epoch_time = [
-            (util.epoch(start_time), util.epoch(end_time), resolution)
-            for start_time, end_time, resolution in result
-        ]
 
-        return result_epoch_time
+class SortedChartCache(CacheOperations):
+    '''Cache engine keeping the periods in sorted parallel lists of begin, end and data,
+    looked up by bisection. Since the periods are disjoint, a lookup is O(log n + k) and
+    only allocates the Periods it returns.
+    '''
 
+    def __init__(self, max_bytes=None, evict_policy=EVICT_DROP, store=None,
+                 write_through=True):
+        self._begins = []
+        self._ends = []
+        self._data = []
+        self._init_cache(max_bytes, evict_policy, store, write_through)
+
+    def periods(self, start, end):
+        # the periods are disjoint, so ends are sorted as well
+        lo = bisect.bisect_right(self._ends, start)
+        hi = bisect.bisect_left(self._begins, end, lo)
+        return list(map(Period, self._begins[lo:hi], self._ends[lo:hi], self._data[lo:hi]))
+
+    def replace_periods(self, old, new):
+        lo = bisect.bisect_left(self._begins, old[0].begin if old else new[0][0])
+        hi = lo + len(old)
+        self._begins[lo:hi] = [begin for begin, _, _ in new]
+        self._ends[lo:hi] = [end for _, end, _ in new]
+        self._data[lo:hi] = [data for _, _, data in new]
+        for p in old:
+            self._period_removed(*p)
+        for p in new:
+            self._period_added(*p)
+
+    def all_periods(self):
+        return list(self)
+
+    def __len__(self):
+        return len(self._begins)
+
+    def __iter__(self):
+        return map(Period, self._begins, self._ends, self._data)
 
     def __repr__(self):
-        return pprint.pformat(sorted(self), indent=4)
-
-
+        return pprint.pformat(list(self), indent=4)
@@ -1,18 +1,24 @@
+import asyncio
+import functools
 import logging
+import time
 import chart_cache as cc
+import events
+import render
 import util
 
-
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 
 class Controller:
-    '''All time units are in epoch time in this class, everything else in this package uses
-    pd.TimeStamp unless otherwise stated in the code
+    '''All time units are in epoch time in this class, as they are in the cache. The cache's
+    public methods also take pd.Timestamp, which they convert on the way in.
     '''
 
     @staticmethod
-    async def create(ui, backend, start_time, end_time, cache=None):
+    async def create(ui, backend, start_time, end_time, cache=None, cache_cls=cc.ChartCache,
+                     max_cache_bytes=None, max_inflight=4, prefetcher=None, tiled=False,
+                     frame_interval=None, pixel_width=None, store=None):
         '''Initializes your object with the starting chart range. You should perform
         any service calls needed to render the chart as quickly as possible. The
         startTime and endTime are guaranteed to be aligned with the chart period;
@@ -25,6 +31,24 @@ class Controller:
         endTime - The last datapoint to be rendered, exclusive, in seconds
         since the epoch.
 
+        cache - A cache to start from, by default an empty one of cache_cls, which is either
+        cc.ChartCache (interval tree) or cc.SortedChartCache (sorted arrays), holding at most
+        max_cache_bytes.
+        max_inflight - How many backend requests can be in flight at once.
+        prefetcher - A prefetch.Prefetcher to speculatively fetch what's likely to be viewed
+        next, or None.
+        tiled - Expand every backend request to whole tiles (see util.tile_keys), so the same
+        requests are made and cached whatever the exact viewport is.
+        frame_interval - Render at most once every frame_interval seconds, coalescing the
+        renders in between (see render.RenderScheduler), or render every time if None.
+        pixel_width - Render the datapoints cached for the viewport, at whatever resolution,
+        reduced to 4 per pixel column of a chart this wide (see render.m4), unless the
+        viewport's resolution has no more datapoints than that; render the datapoints at the
+        viewport's resolution then, or if None.
+        store - A persistent store.MmapStore for the default cache to write through to and read
+        through from. What's written is only found again after a restart once the store is
+        flushed.
+
         The async keyword doesn't work with magic methods, e.g. __init__, hence this method
         '''
         self = Controller()
@@ -34,19 +58,47 @@ class Controller:
         self._backend_reqs = {}
         # maps task_id -> (start_time, end_time, resolution)
         self._ui_reqs = {}
+        # (start_time, end_time, resolution) of the backend requests still waiting for data
+        self._pending = set()
+        # (start_time, end_time, resolution) -> asyncio.Task of the backend requests not done
+        self._fetches = {}
+        # the pending requests that were speculatively made by the prefetcher
+        self._prefetching = set()
+        # how many pending requests got cancelled because no viewport needed them anymore
+        self.cancelled_requests = 0
+        # set while no user driven request is in flight, prefetches wait for it
+        self._user_fetches = 0
+        self._user_idle = asyncio.Event()
+        self._user_idle.set()
+        self.prefetcher = prefetcher
+        self.tiled = tiled
+        self.pixel_width = pixel_width
+        self._renderer = render.RenderScheduler(ui, frame_interval) if frame_interval else None
+        # (start_time, end_time, resolution) of what the UI last got all the datapoints of
+        self._rendered = None
         # id for the last started task
         self._cur_tid = 0
+        # limits the backend requests in flight
+        self._inflight = asyncio.Semaphore(max_inflight)
         self._start_time = start_time
         self._end_time = end_time
-        self._cache = cc.ChartCache() if not cache else cache
-
-        self.respond_ui(
-            [None] * util.num_datapoints(end_time - start_time), start_time, end_time
-        )
+        self._cache = (cache_cls(max_bytes=max_cache_bytes, store=store) if cache is None
+                       else cache)
+        # never evict what's on screen
+        self._cache.pin(start_time, end_time)
+        await self.read_stored(start_time, end_time, util.resolution(end_time - start_time))
+        # the datapoints of the viewport
+        self._buffer = render.RenderBuffer(self._cache)
+        self._buffer.move(start_time, end_time, util.resolution(end_time - start_time))
+
+        self.respond_ui(self.buffered_datapoints(), start_time, end_time)
         self.init_metadata(start_time, end_time)
-        await self.request_data(start_time, end_time)
+        await self.request_intervals(
+            [(start_time, end_time, util.resolution(end_time - start_time))])
 
-        self._cur_tid += 1
+        self.cur_tid += 1
+        if self.prefetcher:
+            self.prefetcher.attach(self)
         return self
 
     def init_metadata(self, start_time, end_time):
@@ -60,20 +112,247 @@ class Controller:
             util.resolution(end_time-start_time))
 
 
-    def respond_ui(self, data, ui_req_start_time, ui_req_end_time):
-        self.record_ui_req(self.cur_tid,
-                           (ui_req_start_time,
-                            ui_req_end_time,
-                            util.resolution(ui_req_end_time - ui_req_start_time)))
-        self.ui.set_chart_data(data)
+    def respond_ui(self, data, ui_req_start_time, ui_req_end_time, tid=None):
+        '''Render data, or what the data callable returns, for task tid (the current one by
+        default)'''
+        if tid is None:
+            tid = self.cur_tid
+        viewport = (ui_req_start_time,
+                    ui_req_end_time,
+                    util.resolution(ui_req_end_time - ui_req_start_time))
+        self.record_ui_req(tid, viewport)
+        if self._renderer:
+            self._renderer.render(tid, data)
+        else:
+            self.ui.set_chart_data(data() if callable(data) else data)
+            self._rendered = viewport
+        if events.sampled():
+            events.log('render', tid=tid, start=ui_req_start_time, end=ui_req_end_time,
+                       resolution=viewport[2], scheduled=self._renderer is not None)
+
+    def respond_ui_buffer(self, first, last, tid):
+        '''Render the buffered viewport for task tid after its datapoints from first to last
+        changed. When the UI already shows the rest of them, only those are sent, through
+        the UI's set_chart_data_range.'''
+        viewport = self._buffer.viewport
+        if (viewport == self._rendered and hasattr(self.ui, 'set_chart_data_range')
+                and not self.pixel_width):
+            self.ui.set_chart_data_range(first, self._buffer.tolist(first, last))
+            if events.sampled():
+                events.log('render_range', tid=tid, offset=first, datapoints=last - first)
+            return
+        self.respond_ui(self.buffered_datapoints, viewport[0], viewport[1], tid)
+
+    def buffered_datapoints(self):
+        '''The datapoints to render for the buffered viewport'''
+        if self.pixel_width and len(self._buffer.values) > 4 * self.pixel_width:
+            start_time, end_time, _ = self._buffer.viewport
+            return util.to_list(render.m4(*self.cache.get_native(start_time, end_time,
+                                                                 read_through=False),
+                                          start_time, end_time, self.pixel_width))
+        return self._buffer.tolist()
+
+    @property
+    def dropped_renders(self):
+        return self._renderer.dropped if self._renderer else 0
 
     async def request_data(self, start_time, end_time, data_resolution=None):
         if not data_resolution:
             data_resolution = util.resolution(end_time - start_time)
         self.record_backend_req((start_time, end_time, data_resolution), self.cur_tid)
-        await self.backend.request_temperature_data(
-            start_time, end_time, data_resolution
+        self._pending.add((start_time, end_time, data_resolution))
+        await self.wait_fetches([self.start_fetch((start_time, end_time, data_resolution))])
+
+    async def request_intervals(self, intervals):
+        '''Request every (start_time, end_time, resolution) in intervals from the backend
+        concurrently, except for the parts pending requests already cover'''
+        if self.tiled:
+            # the whole tiles get planned, so what the store has of them is needed first
+            for tile in self.tiles(intervals, needed=False):
+                await self.read_stored(*tile)
+        requests = self.requests_for(intervals)
+        # record all of them for the current task before any of them can come back
+        for start_end_time_resolution in requests:
+            self.record_backend_req(start_end_time_resolution, self.cur_tid)
+            self._pending.add(start_end_time_resolution)
+        await self.wait_fetches([self.start_fetch(request) for request in requests])
+
+    async def wait_fetches(self, tasks):
+        '''Wait for the fetch tasks to be done. Cancelled ones are left out; the ones that
+        failed get logged, fetch already forgot their requests, so a later viewport needing the
+        data requests it again.'''
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if (isinstance(result, BaseException)
+                    and not isinstance(result, asyncio.CancelledError)):
+                logger.error('Fetching data failed', exc_info=result)
+
+    def requests_for(self, intervals, hand_over=True):
+        '''The backend requests intervals need, leaving out what pending requests cover (see
+        uncovered_by_pending). When tiled, these are whole tiles, and a tile partially covered
+        by pending requests still gets requested.
+        '''
+        if self.tiled:
+            return [
+                tile for tile in self.tiles(intervals)
+                if self.uncovered_by_pending(*tile, hand_over=hand_over)
+            ]
+        return [
+            uncovered
+            for interval in intervals
+            for uncovered in self.uncovered_by_pending(*interval, hand_over=hand_over)
+        ]
+
+    def tiles(self, intervals, needed=True):
+        '''The (start_time, end_time, resolution) of the tiles the intervals need, or with
+        needed=False, of all the tiles they are in'''
+        keys = {
+            key
+            for interval in intervals
+            for key in (self.cache.tiles_be_updated(*interval, read_through=False) if needed
+                        else util.tile_keys(*interval))
+        }
+        return [util.tile_range(key) for key in sorted(keys)]
+
+    async def prefetch(self, start_time, end_time, data_resolution, limit):
+        '''Speculatively request, at most limit requests, what neither the cache, its store
+        nor a pending request has of (start_time, end_time) at data_resolution. The requests
+        belong to no task, go out once no user driven request is in flight, and are returned.
+        '''
+        window = [(start_time, end_time, data_resolution)]
+        for stored in (self.tiles(window, needed=False) if self.tiled else window):
+            await self.read_stored(*stored)
+        requests = self.requests_for(
+            self.cache.intervals_be_updated(start_time, end_time, data_resolution,
+                                            read_through=False),
+            hand_over=False
+        )[:limit]
+        for request in requests:
+            self.record_backend_req(request, None)
+            self._pending.add(request)
+            self._prefetching.add(request)
+            self.start_fetch(request, prefetch=True).add_done_callback(
+                functools.partial(self.prefetch_done, request))
+        return requests
+
+    def prefetch_done(self, request, task):
+        '''Log a prefetch that failed, fetch already forgot its request, and tell the
+        prefetcher'''
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error('Prefetching data failed', exc_info=task.exception())
+        if self.prefetcher:
+            self.prefetcher.prefetch_failed(request)
+
+    def uncovered_by_pending(self, start_time, end_time, data_resolution, hand_over=True):
+        '''The parts of (start_time, end_time) no pending request at data_resolution or finer
+        covers. With hand_over, the covering pending requests are handed over to the current
+        task, so their data renders for it when it arrives.
+        '''
+        covering = sorted(
+            (pending_start, pending_end, pending_resolution)
+            for pending_start, pending_end, pending_resolution in self._pending
+            if pending_resolution <= data_resolution
+            and pending_start < end_time and pending_end > start_time
         )
+        uncovered = []
+        cursor = start_time
+        for pending in covering:
+            pending_start, pending_end, _ = pending
+            if cursor < pending_start:
+                uncovered.append((cursor, pending_start, data_resolution))
+            cursor = max(cursor, pending_end)
+            if hand_over:
+                self.record_backend_req(pending, self.cur_tid)
+                self._prefetching.discard(pending)
+        if cursor < end_time:
+            uncovered.append((cursor, end_time, data_resolution))
+        return uncovered
+
+    def start_fetch(self, request, prefetch=False):
+        '''Schedule fetch for the (start_time, end_time, resolution) request as a task, which
+        cancel_requests can cancel'''
+        task = asyncio.ensure_future(self.fetch(*request, prefetch=prefetch))
+        self._fetches[request] = task
+        if not prefetch:
+            self._user_fetches += 1
+            self._user_idle.clear()
+
+        def forget(_):
+            if self._fetches.get(request) is task:
+                del self._fetches[request]
+            if not prefetch:
+                self._user_fetches -= 1
+                if not self._user_fetches:
+                    self._user_idle.set()
+        task.add_done_callback(forget)
+        return task
+
+    def cancel_superseded(self, start_time, end_time):
+        '''Cancel the pending requests the viewport (start_time, end_time) doesn't need,
+        except for prefetches, which the prefetcher looks after'''
+        self.cancel_requests([
+            request for request in self._pending - self._prefetching
+            if request[1] <= start_time or request[0] >= end_time
+        ])
+
+    def cancel_requests(self, requests):
+        '''Cancel pending requests. The ones still waiting for a free slot never reach the
+        backend, the ones in flight get cancelled in the backend, through the asyncio task or,
+        for backends that already returned and will call back, through their
+        cancel_temperature_data if they have one.
+        '''
+        for request in requests:
+            self.forget_request(request)
+            task = self._fetches.get(request)
+            if task is not None:
+                task.cancel()
+            elif hasattr(self.backend, 'cancel_temperature_data'):
+                self.backend.cancel_temperature_data(*request)
+            self.cancelled_requests += 1
+        if requests and events.sampled():
+            events.log('cancel', requests=len(requests))
+
+    async def fetch(self, start_time, end_time, data_resolution, prefetch=False):
+        '''Issue a backend request once fewer than max_inflight are in flight, and for a
+        prefetch, once no user driven request is. A backend returning the data right away
+        instead of calling back gets it merged on arrival.'''
+        if prefetch:
+            await self._user_idle.wait()
+        # decided up front, so the timing is only taken for the fetches logged
+        log_event = events.sampled()
+        if log_event:
+            requested = time.perf_counter()
+        try:
+            async with self._inflight:
+                data = await self.backend.request_temperature_data(
+                    start_time, end_time, data_resolution
+                )
+            if log_event:
+                events.log('fetch', start=start_time, end=end_time, resolution=data_resolution,
+                           prefetch=prefetch, seconds=round(time.perf_counter() - requested, 6),
+                           called_back=data is None)
+            if data is not None:
+                self.receive_temperature_data(start_time, end_time, data_resolution, data)
+        except Exception:
+            # no data is coming for it, nothing is to wait for it or be coalesced onto it
+            self.forget_request((start_time, end_time, data_resolution))
+            raise
+
+    def forget_request(self, request):
+        '''Stop tracking the backend request as pending'''
+        self._pending.discard(request)
+        self._prefetching.discard(request)
+        self.backend_reqs.pop(request, None)
+
+    async def read_stored(self, start_time, end_time, data_resolution):
+        '''Bring what the cache's store has of (start_time, end_time) into the cache, reading
+        the disk in a worker thread so the event loop never waits on it'''
+        pieces = self.cache.stored(start_time, end_time, data_resolution)
+        if pieces:
+            loaded = await asyncio.get_running_loop().run_in_executor(
+                None, self.cache.read_stored, pieces)
+            self.cache.merge_stored(loaded)
 
     def record_ui_req(self, tid, start_end_time_resolution_tup):
         self.ui_reqs[tid] = start_end_time_resolution_tup
@@ -86,12 +365,27 @@ class Controller:
         return self.ui_reqs[tid]
 
     def backend_req_tid(self, start_end_time_resolution):
-        return self.backend_reqs[start_end_time_resolution]
+        '''The task the backend request is for, None for a prefetch or a request no task
+        needs anymore'''
+        return self.backend_reqs.get(start_end_time_resolution)
+
+    def compact_reqs(self):
+        '''Forget the tasks that can no longer render (see receive_temperature_data), and
+        the backend requests that are done or only belong to them, so the bookkeeping stays
+        bounded by the requests in flight'''
+        oldest_tid = self.cur_tid - 1
+        self.ui_reqs = {
+            tid: times_and_resolution for tid, times_and_resolution in self.ui_reqs.items()
+            if tid >= oldest_tid
+        }
+        self.backend_reqs = {
+            request: tid for request, tid in self.backend_reqs.items()
+            if request in self._pending and (tid is None or tid >= oldest_tid)
+        }
 
-    def data_fromcache(self, start_time, end_time, at_resolution):
-        return self.cache.get(
-            start_time, end_time, at_resolution
-        )
+    @property
+    def bookkeeping_sizes(self):
+        return {'ui_reqs': len(self.ui_reqs), 'backend_reqs': len(self.backend_reqs)}
 
     @property
     def cur_tid(self):
@@ -100,6 +394,7 @@ class Controller:
     @cur_tid.setter
     def cur_tid(self, v):
         self._cur_tid = v
+        self.compact_reqs()
 
     @property
     def ui_reqs(self):
@@ -117,6 +412,10 @@ class Controller:
     def backend_reqs(self, v):
         self._backend_reqs = v
 
+    @property
+    def prefetching(self):
+        return self._prefetching
+
     @property
     def cache(self):
         return self._cache
@@ -124,6 +423,10 @@ class Controller:
     @cache.setter
     def cache(self, new_cache):
         self._cache = new_cache
+        self._buffer = render.RenderBuffer(new_cache)
+        self._buffer.move(self.start_time, self.end_time,
+                          util.resolution(self.end_time - self.start_time))
+        self._rendered = None
 
     @property
     def start_time(self):
@@ -132,6 +435,7 @@ class Controller:
     @start_time.setter
     def start_time(self, new_start_time):
         self._start_time = new_start_time
+        self.cache.pin(self.start_time, self.end_time)
 
     @property
     def end_time(self):
@@ -140,79 +444,75 @@ class Controller:
     @end_time.setter
     def end_time(self, new_end_time):
         self._end_time = new_end_time
+        self.cache.pin(self.start_time, self.end_time)
 
     async def set_start_time(self, new_start_time):
-        if self.start_time == new_start_time:
-            return
-        new_resolution = util.resolution(abs(new_start_time - self.end_time))
-        intervals_be_updated = self.cache.intervals_be_updated(
-            new_start_time, self.end_time, new_resolution
-        )
-
-        if not intervals_be_updated:
-            self.respond_ui(
-                self.cache.get(new_start_time, self.end_time), new_start_time, self.end_time
-            )
-        else:
-            filler = [None] * util.num_datapoints(
-                max(self.start_time - new_start_time, 0), data_resolution=new_resolution)
-            from_cache = self.data_fromcache(
-                max(self.start_time, new_start_time),
-                self.end_time,
-                new_resolution
-            )
-            be_rendered = filler + from_cache
-            self.respond_ui(be_rendered, new_start_time, self.end_time)
-            for req_start_time, req_end_time, _ in intervals_be_updated:
-                await self.request_data(req_start_time, req_end_time, new_resolution)
-
-        self.start_time = new_start_time
-        # increment id for the next set request from ui
-        self.cur_tid += 1
-
+        await self.set_range(new_start_time, self.end_time)
 
     async def set_end_time(self, new_end_time):
-        if self.end_time == new_end_time:
+        await self.set_range(self.start_time, new_end_time)
+
+    async def set_range(self, new_start_time, new_end_time):
+        '''Move both ends of the viewport at once, e.g. for a zoom or a pan: the new viewport
+        is planned, rendered and fetched for once, with no intermediate viewport'''
+        moved_start = new_start_time != self.start_time
+        moved_end = new_end_time != self.end_time
+        if not moved_start and not moved_end:
             return
-        new_resolution = util.resolution(abs(new_end_time - self.start_time))
+        self.cancel_superseded(new_start_time, new_end_time)
+        # what arrives for the new viewport is on screen from now on
+        self.cache.pin(new_start_time, new_end_time)
+        new_resolution = util.resolution(abs(new_end_time - new_start_time))
+        await self.read_stored(new_start_time, new_end_time, new_resolution)
         intervals_be_updated = self.cache.intervals_be_updated(
-            self.start_time, new_end_time, new_resolution
+            new_start_time, new_end_time, new_resolution, read_through=False
         )
 
-        if not intervals_be_updated:
-            self.respond_ui(
-                self.cache.get(self.start_time, new_end_time), self.start_time, new_end_time
-            )
-        else:
-            filler = [None] * util.num_datapoints(
-                max(new_end_time - self.end_time, 0), data_resolution=new_resolution)
-            from_cache = self.data_fromcache(
-                self.start_time, min(self.end_time, new_end_time), new_resolution
-            )
-            be_rendered = from_cache + filler
-            self.respond_ui(be_rendered, self.start_time, new_end_time)
-            for req_start_time, req_end_time, _ in intervals_be_updated:
-                await self.request_data(
-                    req_start_time, req_end_time, data_resolution=new_resolution)
-
-        self.end_time = new_end_time
+        self._buffer.move(new_start_time, new_end_time, new_resolution)
+        # what's cached already, None where the requests are still to fill in
+        self.respond_ui(self.buffered_datapoints(), new_start_time, new_end_time)
+        if intervals_be_updated:
+            await self.request_intervals(intervals_be_updated)
+
+        # only the ends this call moved, another call may have moved the other one since
+        if moved_start:
+            self.start_time = new_start_time
+        if moved_end:
+            self.end_time = new_end_time
         # increment id for the next set request from ui
         self.cur_tid += 1
+        if self.prefetcher:
+            await self.prefetcher.viewport_changed(self.start_time, self.end_time)
 
 
     def receive_temperature_data(self, start_time, end_time, data_resolution, data):
         '''Merge new data into cache and trigger a rendering if it doesn't negatively
         affect user experience'''
         data_task_id = self.backend_req_tid((start_time, end_time, data_resolution))
+        self.forget_request((start_time, end_time, data_resolution))
 
         # Only render when the data we are receiving is for a task (thus a set request from UI)
         # that we have not finished renderings for. Otherwise, only record the data
         self.cache.merge(start_time, end_time, data_resolution, data)
-        if self.cur_tid <= data_task_id + 1:
-            req_start_time, req_end_time, req_resolution =\
-                self.ui_req_times_and_resolution(data_task_id)
-            be_rendered = self.cache.get(req_start_time, req_end_time, req_resolution)
-            self.respond_ui(be_rendered, req_start_time, req_end_time)
+        changed = self._buffer.refresh(start_time, end_time)
+        rendering = data_task_id is not None and self.cur_tid <= data_task_id + 1
+        if events.sampled():
+            events.log('receive', start=start_time, end=end_time, resolution=data_resolution,
+                       datapoints=len(data), tid=data_task_id, rendering=rendering)
+        if rendering:
+            viewport = self.ui_req_times_and_resolution(data_task_id)
+            if viewport == self._buffer.viewport:
+                if changed:
+                    self.respond_ui_buffer(*changed, data_task_id)
+                return
+            # a viewport the buffer moved away from since
+            req_start_time, req_end_time, req_resolution = viewport
+            self.respond_ui(
+                lambda: self.cache.get(req_start_time, req_end_time, req_resolution,
+                                       read_through=False),
+                req_start_time, req_end_time, data_task_id)
         else:
-            logging.debug('''receive_temperature_data: absorbing data but not rendering''')
+            if changed:
+                # the UI no longer shows what the buffer has
+                self._rendered = None
 
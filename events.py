@@ -0,0 +1,45 @@
+'''Structured logging of the controller's, cache's and backend's hot path events: every event
+is a name and summary fields (counts, ranges, durations), never the datapoints themselves.
+
+Events are logged at DEBUG on the 'events' logger, with the fields also given to handlers as
+the record's event and fields attributes. Only a sample_rate fraction of them is logged. Guard
+every event with sampled(), so nothing is computed for the events that aren't logged:
+
+    if events.sampled():
+        events.log('merge', start=start, end=end, datapoints=len(values))
+'''
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+# fraction of the events logged, see set_sample_rate
+sample_rate = 1.0
+
+
+def set_sample_rate(rate):
+    global sample_rate
+    if not 0 <= rate <= 1:
+        raise ValueError(f'Sample rate {rate} is not between 0 and 1')
+    sample_rate = rate
+
+
+def sampled():
+    '''Whether the event about to happen is to be logged'''
+    return logger.isEnabledFor(logging.DEBUG) and (
+        sample_rate >= 1 or random.random() < sample_rate)
+
+
+def log(event, **fields):
+    logger.debug('%s %s', event, _Fields(fields), extra={'event': event, 'fields': fields})
+
+
+class _Fields:
+    '''key=value pairs, only formatted if a handler emits the record'''
+
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join(f'{key}={value}' for key, value in self.fields.items())
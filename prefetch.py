@@ -0,0 +1,91 @@
+import util
+
+
+class Prefetcher:
+    '''Watches the viewport of a Controller and speculatively fetches into its cache the
+    window next to the viewport in the direction it's moving, and when zooming out, the
+    viewport zoomed out one more step at the coarser resolution that needs. Prefetches go out
+    once no user driven request is in flight, and at most budget of them are pending at once.
+
+    stats - issued: prefetch requests sent; hits: prefetched ranges a later viewport used;
+    wasted: prefetched ranges that got cancelled or failed, or that history more recent
+    prefetches were made before any viewport used them
+    '''
+
+    def __init__(self, budget=2, history=8):
+        self.budget = budget
+        self.history = history
+        self.controller = None
+        self._viewport = None
+        # prefetched (start_time, end_time, resolution) no viewport has used yet, oldest first
+        self._unused = []
+        self.stats = {'issued': 0, 'hits': 0, 'wasted': 0}
+
+    def attach(self, controller):
+        self.controller = controller
+        self._viewport = (controller.start_time, controller.end_time)
+
+    async def viewport_changed(self, start_time, end_time):
+        resolution = util.resolution(end_time - start_time)
+        still_unused = []
+        for prefetched in self._unused:
+            prefetched_start, prefetched_end, prefetched_resolution = prefetched
+            if (prefetched_start < end_time and prefetched_end > start_time
+                    and prefetched_resolution <= resolution):
+                self.stats['hits'] += 1
+            else:
+                still_unused.append(prefetched)
+        self._unused = still_unused
+
+        windows = self.predict(start_time, end_time)
+        self._viewport = (start_time, end_time)
+
+        # outstanding prefetches neither the viewport nor a predicted window needs
+        wanted = [(start_time, end_time)] + [(start, end) for start, end, _ in windows]
+        stale = [
+            request for request in self.controller.prefetching
+            if not any(request[0] < end and request[1] > start for start, end in wanted)
+        ]
+        self.controller.cancel_requests(stale)
+        self.stats['wasted'] += len(stale)
+        self._unused = [prefetched for prefetched in self._unused if prefetched not in stale]
+
+        for start, end, window_resolution in windows:
+            room = self.budget - len(self.controller.prefetching)
+            if room <= 0:
+                break
+            requests = await self.controller.prefetch(start, end, window_resolution, room)
+            self.stats['issued'] += len(requests)
+            self._unused.extend(requests)
+
+        if len(self._unused) > self.history:
+            self.stats['wasted'] += len(self._unused) - self.history
+            self._unused = self._unused[-self.history:]
+
+    def prefetch_failed(self, request):
+        '''No data is coming for the (start_time, end_time, resolution) prefetch request'''
+        if request in self._unused:
+            self._unused.remove(request)
+            self.stats['wasted'] += 1
+
+    def predict(self, start_time, end_time):
+        '''(start_time, end_time, resolution) of the windows likely to be viewed next'''
+        previous_start, previous_end = self._viewport
+        width = end_time - start_time
+        resolution = util.resolution(width)
+        windows = []
+        # the center of the viewport moved, keep going in that direction
+        moved = (start_time + end_time) - (previous_start + previous_end)
+        if moved > 0:
+            windows.append((end_time, end_time + width, resolution))
+        elif moved < 0:
+            windows.append((start_time - width, start_time, resolution))
+        # zoomed out, zoom out once more
+        if width > previous_end - previous_start:
+            zoomed_resolution = util.resolution(2 * width)
+            windows.append((
+                (start_time - width // 2) // zoomed_resolution * zoomed_resolution,
+                -(-(end_time + width // 2) // zoomed_resolution) * zoomed_resolution,
+                zoomed_resolution,
+            ))
+        return windows
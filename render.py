@@ -0,0 +1,152 @@
+import asyncio
+import time
+import numpy as np
+import util
+
+
+class RenderScheduler:
+    '''Renders to the UI at most once every frame_interval seconds. A render asked for within
+    a frame of the last one waits for the end of that frame, and replaces the one already
+    waiting, if any. Renders for an older task than the last one asked for are dropped.
+
+    datapoints to render can be given as a callable, which is only called if the render
+    actually happens.
+
+    dropped - how many renders never made it to the UI
+    '''
+
+    def __init__(self, ui, frame_interval):
+        self.ui = ui
+        self.frame_interval = frame_interval
+        self.dropped = 0
+        self._last_render = float('-inf')
+        self._newest_tid = -1
+        # (tid, datapoints) waiting for the end of the frame
+        self._waiting = None
+
+    def render(self, tid, datapoints):
+        if tid < self._newest_tid:
+            self.dropped += 1
+            return
+        self._newest_tid = tid
+        if self._waiting is not None:
+            self.dropped += 1
+            self._waiting = (tid, datapoints)
+            return
+        wait = self._last_render + self.frame_interval - time.monotonic()
+        if wait > 0:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # called back from outside the event loop, there's nothing to wait on
+                wait = 0
+        if wait <= 0:
+            self._render(datapoints)
+        else:
+            self._waiting = (tid, datapoints)
+            loop.call_later(wait, self.flush)
+
+    def flush(self):
+        '''Render what's waiting for the end of the frame now'''
+        if self._waiting is None:
+            return
+        _, datapoints = self._waiting
+        self._waiting = None
+        self._render(datapoints)
+
+    def _render(self, datapoints):
+        if callable(datapoints):
+            datapoints = datapoints()
+        self._last_render = time.monotonic()
+        self.ui.set_chart_data(datapoints)
+
+
+class RenderBuffer:
+    '''The datapoints of the viewport read from cache, NaN where it has no data yet, in an
+    array allocated once and only grown. Moving the viewport at the same resolution shifts the
+    datapoints still in view in place and only reads the newly exposed ones from the cache;
+    refresh re-reads just the datapoints new data covers. Only the cache is read, not its
+    store, which the controller reads off the event loop beforehand.
+
+    viewport - (start_time, end_time, resolution) the datapoints are for, in epoch time
+    values - the datapoints, a view of the array
+    '''
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.viewport = None
+        self._array = np.empty(0)
+        self.values = self._array[:0]
+
+    def move(self, start_time, end_time, resolution):
+        '''Make the buffer hold the viewport (start_time, end_time) at resolution'''
+        n_datapoints = util.num_datapoints(end_time - start_time, resolution)
+        # old positions of the datapoints still in view, and how far they move
+        first, last, shift = 0, 0, 0
+        if self.viewport is not None:
+            old_start_time, old_end_time, old_resolution = self.viewport
+            shift, misaligned = divmod(start_time - old_start_time, resolution)
+            if (old_resolution == resolution and not misaligned
+                    and start_time < old_end_time and end_time > old_start_time):
+                first, last = max(shift, 0), min(len(self.values), shift + n_datapoints)
+
+        if last <= first:
+            first, last, shift = 0, 0, 0
+        into = first - shift
+        if n_datapoints > len(self._array):
+            array = np.empty(n_datapoints)
+            array[into:into + last - first] = self.values[first:last]
+            self._array = array
+        else:
+            # overlapping ranges copy correctly
+            self._array[into:into + last - first] = self.values[first:last]
+        self.values = self._array[:n_datapoints]
+        self.viewport = (start_time, end_time, resolution)
+        self._read(0, into)
+        self._read(into + last - first, n_datapoints)
+
+    def refresh(self, start_time, end_time):
+        '''Re-read the datapoints of the viewport (start_time, end_time) covers from the
+        cache, and return the (first, last) of them, or None if it covers none'''
+        if self.viewport is None:
+            return None
+        view_start_time, view_end_time, resolution = self.viewport
+        first = (max(start_time, view_start_time) - view_start_time) // resolution
+        last = -(-(min(end_time, view_end_time) - view_start_time) // resolution)
+        if first >= last:
+            return None
+        self._read(first, last)
+        return first, last
+
+    def tolist(self, first=0, last=None):
+        '''The datapoints from first to last as a list, with None for no data'''
+        return util.to_list(self.values[first:last])
+
+    def _read(self, first, last):
+        if first >= last:
+            return
+        start_time, _, resolution = self.viewport
+        self.cache.get_into(start_time + first * resolution, start_time + last * resolution,
+                            resolution, self.values[first:last], read_through=False)
+
+
+def m4(times, values, start_time, end_time, width):
+    '''Downsample the datapoints at epoch times (in time order) in [start_time, end_time)
+    for a chart width pixels wide with M4: the first, the min, the max and the last datapoint
+    of every pixel column, in time order, so every spike still shows. Returns 4 * width
+    datapoints, 4 for every column, NaN for the columns with none.
+    '''
+    reduced = np.full((width, 4), np.nan)
+    if not len(values):
+        return reduced.ravel()
+    columns = (times - start_time) * width // (end_time - start_time)
+    # where every occupied column's datapoints start, and end
+    first = np.flatnonzero(np.diff(columns, prepend=columns[0] - 1))
+    last = np.append(first[1:], len(values)) - 1
+    # the datapoints sorted by value within their column
+    by_value = np.lexsort((values, columns))
+    lowest = by_value[first]
+    highest = by_value[last]
+    reduced[columns[first]] = values[np.stack([
+        first, np.minimum(lowest, highest), np.maximum(lowest, highest), last], axis=1)]
+    return reduced.ravel()
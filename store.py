@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import numpy as np
+import util
+
+
+class MmapStore:
+    '''Persistent tier under a cache: the datapoints of every resolution in a file of float64,
+    memory-mapped, the datapoint at epoch time t at index (t - origin) // resolution. Only the
+    pages read or written are ever loaded, by the OS. Which datapoints hold data is kept in a
+    small index next to them, as runs of [first, last) indices per resolution; the rest of the
+    files is sparse and meaningless. The index is only written by flush(), until then the
+    data written since isn't found by a store reopened over the directory.
+
+    The origin of a resolution is the start of the tile (see util.TILE_SECONDS) of the first
+    datapoint written at it. Data written before the origin moves it back, by at least the
+    span the file already has, so the datapoints kept are copied a bounded number of times.
+    Files grow by at least the span they already have as well.
+
+    Data that doesn't start on the datapoint grid of its resolution isn't stored.
+    '''
+
+    INDEX = 'index.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # resolution -> epoch time of the first datapoint of its file
+        self.origins = {}
+        # resolution -> sorted, disjoint [first, last) runs of indices holding data
+        self.coverage = {}
+        index_path = os.path.join(directory, self.INDEX)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            self.origins = {
+                int(resolution): origin for resolution, origin in index['origins'].items()
+            }
+            self.coverage = {
+                int(resolution): [tuple(run) for run in runs]
+                for resolution, runs in index['coverage'].items()
+            }
+        # resolution -> np.memmap of its file
+        self._arrays = {}
+        # writes happen on the event loop, reads in worker threads, and moving an origin
+        # replaces a file
+        self._lock = threading.Lock()
+        # whether coverage changed since the index was last written
+        self._index_dirty = False
+
+    @property
+    def resolutions(self):
+        return sorted(self.coverage)
+
+    def write(self, start, end, resolution, values):
+        '''Store the datapoints in values, the first at epoch time start, up to end'''
+        if start % resolution:
+            return
+        n_datapoints = min(len(values), -(-(end - start) // resolution))
+        if n_datapoints <= 0:
+            return
+        with self._lock:
+            if start < self.origins.get(resolution, start + 1):
+                self._move_origin(resolution, start)
+            first = (start - self.origins[resolution]) // resolution
+            last = first + n_datapoints
+            self._array(resolution, last)[first:last] = values[:n_datapoints]
+            self._cover(resolution, first, last)
+            self._index_dirty = True
+
+    def covered(self, start, end, resolution):
+        '''(begin, end) epoch times of the stored runs of datapoints at resolution overlapping
+        [start, end)'''
+        origin = self.origins.get(resolution)
+        if origin is None:
+            return []
+        first = (start - origin) // resolution
+        last = -(-(end - origin) // resolution)
+        return [
+            (origin + max(run_first, first) * resolution,
+             origin + min(run_last, last) * resolution)
+            for run_first, run_last in self.coverage.get(resolution, [])
+            if run_first < last and run_last > first
+        ]
+
+    def read(self, start, end, resolution):
+        '''The stored datapoints at resolution from epoch time start up to end, as a view of
+        the file; only meaningful for a range covered() returned'''
+        with self._lock:
+            origin = self.origins[resolution]
+            first = (start - origin) // resolution
+            last = -(-(end - origin) // resolution)
+            return self._array(resolution, last)[first:last]
+
+    def flush(self):
+        '''Write the datapoints and then the index to disk'''
+        for array in self._arrays.values():
+            array.flush()
+        if self._index_dirty:
+            self._write_index()
+            self._index_dirty = False
+
+    def _path(self, resolution):
+        return os.path.join(self.directory, f'{resolution}.f64')
+
+    def _array(self, resolution, length):
+        '''The mapping of the file of resolution, grown to at least length datapoints'''
+        array = self._arrays.get(resolution)
+        if array is not None and len(array) >= length:
+            return array
+        path = self._path(resolution)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size < length * 8:
+            # grown sparse, the OS doesn't allocate the pages until written
+            with open(path, 'ab') as f:
+                f.truncate(max(length, 2 * size // 8) * 8)
+        array = np.memmap(path, dtype=np.float64, mode='r+')
+        self._arrays[resolution] = array
+        return array
+
+    def _move_origin(self, resolution, start):
+        '''Make the file of resolution start at or before epoch time start, moving the
+        datapoints it holds up'''
+        tile_seconds = util.TILE_SECONDS.get(resolution, resolution)
+        origin = start // tile_seconds * tile_seconds
+        old_origin = self.origins.get(resolution)
+        self.origins[resolution] = origin
+        if old_origin is None:
+            return
+        array = self._arrays.pop(resolution, None)
+        if array is None and os.path.exists(self._path(resolution)):
+            array = np.memmap(self._path(resolution), dtype=np.float64, mode='r')
+        span = len(array) if array is not None else 0
+        # back by at least the span of the file, the next write before it likely follows
+        origin = min(origin, (old_origin - span * resolution) // tile_seconds * tile_seconds)
+        self.origins[resolution] = origin
+        shift = (old_origin - origin) // resolution
+        runs = self.coverage.get(resolution, [])
+        path = self._path(resolution)
+        # only the runs holding data are copied, the rest of the new file stays sparse
+        with open(path + '.tmp', 'wb') as f:
+            f.truncate((shift + span) * 8)
+        if runs:
+            moved = np.memmap(path + '.tmp', dtype=np.float64, mode='r+')
+            for run_first, run_last in runs:
+                moved[shift + run_first:shift + run_last] = array[run_first:run_last]
+            moved.flush()
+            del moved
+        os.replace(path + '.tmp', path)
+        self.coverage[resolution] = [
+            (run_first + shift, run_last + shift) for run_first, run_last in runs]
+
+    def _cover(self, resolution, first, last):
+        runs = []
+        for run_first, run_last in self.coverage.get(resolution, []):
+            if run_last < first or run_first > last:
+                runs.append((run_first, run_last))
+            else:
+                first, last = min(first, run_first), max(last, run_last)
+        runs.append((first, last))
+        self.coverage[resolution] = sorted(runs)
+
+    def _write_index(self):
+        index = {
+            'origins': {
+                str(resolution): origin for resolution, origin in self.origins.items()
+            },
+            'coverage': {
+                str(resolution): [list(run) for run in runs]
+                for resolution, runs in self.coverage.items()
+            },
+        }
+        path = os.path.join(self.directory, self.INDEX)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
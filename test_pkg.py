@@ -1,3 +1,9 @@
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import threading
 import pytest
 import util
 import numpy as np
@@ -7,6 +13,10 @@ import chart_cache as cc
 import backend as backend_mod
 import ui as ui_mod
 import controller as controller_mod
+import prefetch as prefetch_mod
+import render as render_mod
+import store as store_mod
+import events
 
 
 np.random.seed(0)
@@ -105,10 +115,11 @@ def test_slice(data_jan1st0000_to_mar1st1159_fixture, state_0am_10am_fixture):
     # assert start and end times for the 2 intervals
     first = periods[0]
     second = periods[1]
-    assert first.begin == am_0
-    assert first.end == am_5
-    assert second.begin == am_5
-    assert second.end == am_10
+    # kept in epoch time
+    assert first.begin == util.epoch(am_0)
+    assert first.end == util.epoch(am_5)
+    assert second.begin == util.epoch(am_5)
+    assert second.end == util.epoch(am_10)
 
 def test_intervals_be_updated_1_interval(state_0am_10am_fixture):
     _, _, cache = state_0am_10am_fixture
@@ -243,6 +254,263 @@ def test_merge(data_jan1st0000_to_mar1st1159_fixture, state_0am_10am_fixture):
     assert len(cache_state) == 60
     assert cache_state == new_data
 
+def test_merge_stores_arrays(state_0am_10am_fixture):
+    am_0, am_10, cache = state_0am_10am_fixture
+    am_11 = util.time_stamp('2000-01-01 11:00:00')
+    cache.merge(am_10, am_11, 60, temperature_data_lst(60))
+    for p in cache:
+        assert isinstance(p.data.values, np.ndarray)
+        assert p.data.values.dtype == np.float64
+        assert not hasattr(p.data, '__dict__')
+    period = sorted(cache)[-1]
+    assert (period.data.start, period.data.resolution) == (util.epoch(am_10), 60)
+
+
+def test_get_with_missing_data(state_0am_10am_fixture):
+    am_0, am_10, cache = state_0am_10am_fixture
+    am_11 = util.time_stamp('2000-01-01 11:00:00')
+    get_result = cache.get(am_0, am_11, 300)
+    assert len(get_result) == 132
+    assert get_result[:120] == cache.get(am_0, am_10, 300)
+    assert get_result[120:] == [None] * 12
+
+
+def test_slice_unaligned(state_1am_to_1am_plus_1mo_fixture):
+    am_1, _, cache = state_1am_to_1am_plus_1mo_fixture
+    am_3 = util.time_stamp('2000-01-01 03:00:00')
+    am_905 = util.time_stamp('2000-01-01 09:05:00')
+    am_10 = util.time_stamp('2000-01-01 10:00:00')
+    expected = cache.get(am_3, am_10, 300)
+    cache.slice(am_905)
+    assert len(cache) == 2
+    # the 9am datapoint is kept on both sides of the cut
+    assert cache.get(am_3, am_10, 300) == expected
+
+def test_rollup_levels(state_1am_to_1am_plus_1mo_fixture):
+    am_1, _, cache = state_1am_to_1am_plus_1mo_fixture
+    am_9 = util.time_stamp('2000-01-01 09:00:00')
+    am_11 = util.time_stamp('2000-01-01 11:00:00')
+    new_data = temperature_data_lst(120)
+    cache.merge(am_9, am_11, 60, new_data)
+    assert cache.rollups[300].blocks and cache.rollups[3600].blocks
+    assert cache.get(am_9, am_11, 300) == util.scaled_data(new_data, 60, 300)
+    assert cache.get(am_9, am_11, 3600) == util.scaled_data(new_data, 60, 3600)
+    # hourly data outside of the merged range is still served from the tree
+    assert cache.get(am_1, am_11, 3600)[:8] == cache.get(am_1, am_9, 3600)
+
+
+@pytest.mark.parametrize('cache_cls', [cc.ChartCache, cc.SortedChartCache])
+def test_get_array(cache_cls):
+    cache = cache_cls()
+    am_9, am_10, am_11 = (util.epoch(f'2000-01-01 {h}:00:00') for h in (9, 10, 11))
+    cache.merge(am_9, am_10, 60, temperature_data_lst(60))
+    cache.merge(am_10, am_11, 300, temperature_data_lst(12))
+    (period, _) = cache.periods(am_9, am_11)
+
+    inside = cache.get_array(am_9 + 600, am_10, 60)
+    assert np.shares_memory(inside, period.data.values)
+    assert not inside.flags.writeable
+    assert util.to_list(inside) == cache.get(am_9 + 600, am_10, 60)
+
+    for start, end, resolution in [(am_9, am_11, 300), (am_9 + 600, am_11, 0),
+                                   (am_9 - 3600, am_10, 60)]:
+        spanning = cache.get_array(start, end, resolution)
+        assert not np.shares_memory(spanning, period.data.values)
+        assert not spanning.flags.writeable
+        assert util.to_list(spanning) == cache.get(start, end, resolution)
+
+
+def test_intervals_be_updated_finer_and_gaps(state_0am_10am_fixture):
+    am_0, am_10, cache = state_0am_10am_fixture
+    am_11 = util.time_stamp('2000-01-01 11:00:00')
+    am_12 = util.time_stamp('2000-01-01 12:00:00')
+    cache.merge(am_11, am_12, 60, temperature_data_lst(60))
+    # finer data satisfies a coarser request, only the gap in between is missing
+    assert cache.intervals_be_updated(am_0, am_12, 3600) == [
+        (util.epoch(am_10), util.epoch(am_11), 3600)]
+
+def test_merge_is_local():
+    cache = cc.ChartCache()
+    day = util.epoch('2000-01-01 00:00:00')
+    # 100 hourly periods with a gap after each
+    for i in range(100):
+        cache.merge(day + 2 * i * 3600, day + (2 * i + 1) * 3600, 60, temperature_data_lst(60))
+    untouched = {id(p.data) for p in cache if util.epoch(p.begin) >= day + 10 * 3600}
+    # fill the 2nd gap, the neighbours get combined with it
+    new_data = temperature_data_lst(60)
+    cache.merge(day + 3 * 3600, day + 4 * 3600, 60, new_data)
+    assert len(cache) == 99
+    assert cache.get(day + 2 * 3600, day + 5 * 3600, 60)[60:120] == new_data
+    assert untouched <= {id(p.data) for p in cache}
+
+
+def test_merge_keeps_finer_data_inside(state_1am_to_1am_plus_1mo_fixture):
+    _, _, cache = state_1am_to_1am_plus_1mo_fixture
+    am_9 = util.time_stamp('2000-01-01 09:00:00')
+    am_905 = util.time_stamp('2000-01-01 09:05:00')
+    am_910 = util.time_stamp('2000-01-01 09:10:00')
+    am_10 = util.time_stamp('2000-01-01 10:00:00')
+    finer = temperature_data_lst(5)
+    cache.merge(am_905, am_910, 60, finer)
+    coarser = temperature_data_lst(12)
+    cache.merge(am_9, am_10, 300, coarser)
+    assert [(p.data.resolution) for p in sorted(cache[am_9:am_10])] == [300, 60, 300]
+    assert cache.get(am_9, am_10, 60)[5:10] == finer
+    assert cache.get(am_9, am_10, 300)[2:] == coarser[2:]
+
+@pytest.mark.parametrize('resolutions', [(60, 300, 3600, 60), (3600, 60, 300, 60, 3600)])
+def test_sorted_cache_matches_chart_cache(resolutions):
+    day = util.epoch('2000-01-01 00:00:00')
+    caches = [cc.ChartCache(), cc.SortedChartCache()]
+    for i, resolution in enumerate(resolutions):
+        start = day + i * 2 * 3600
+        end = start + 6 * 3600
+        data = temperature_data_lst(util.num_datapoints(end - start, resolution))
+        for cache in caches:
+            cache.merge(start, end, resolution, data)
+    tree_cache, sorted_cache = caches
+    assert [tuple(p) for p in tree_cache.periods(day, day + 48 * 3600)] == list(sorted_cache)
+    for resolution in (60, 300, 3600):
+        for start, end in [(day, day + 24 * 3600), (day + 3 * 3600, day + 5 * 3600)]:
+            assert (tree_cache.get(start, end, resolution)
+                    == sorted_cache.get(start, end, resolution))
+            assert (tree_cache.intervals_be_updated(start, end, resolution)
+                    == sorted_cache.intervals_be_updated(start, end, resolution))
+
+@pytest.mark.parametrize('cache_cls', [cc.ChartCache, cc.SortedChartCache])
+def test_eviction_within_budget(cache_cls):
+    day = util.epoch('2000-01-01 00:00:00')
+    # an hour of 1 minute data is 480 bytes, and the rollup blocks of a day 7296 bytes; room
+    # for 4 hours
+    cache = cache_cls(max_bytes=9300)
+    cache.pin(day, day + 3600)
+    for i in range(0, 8, 2):
+        cache.merge(day + i * 3600, day + (i + 1) * 3600, 60, temperature_data_lst(60))
+    # touch the hour starting at 2am so that it's the most recently accessed
+    cache.get(day + 2 * 3600, day + 3 * 3600, 60)
+    cache.merge(day + 8 * 3600, day + 9 * 3600, 60, temperature_data_lst(60))
+
+    assert cache.nbytes <= 9300
+    begins = [p.begin for p in cache.all_periods()]
+    # the pinned viewport and the most recently accessed ones are kept
+    assert begins == [day, day + 2 * 3600, day + 6 * 3600, day + 8 * 3600]
+    usage = cache.nbytes_by_resolution()
+    assert usage[60] == 480 * len(begins)
+    assert sum(usage.values()) == cache.nbytes
+
+@pytest.mark.parametrize('cache_cls', [cc.ChartCache, cc.SortedChartCache])
+def test_eviction_downsamples(cache_cls):
+    day = util.epoch('2000-01-01 00:00:00')
+    cache = cache_cls(max_bytes=9000, evict_policy=cc.EVICT_DOWNSAMPLE)
+    cache.pin(day + 10 * 3600, day + 12 * 3600)
+    datas = [temperature_data_lst(60) for _ in range(12)]
+    for i, data in enumerate(datas):
+        cache.merge(day + i * 3600, day + (i + 1) * 3600, 60, data)
+
+    assert cache.nbytes <= 9000
+    assert cache.nbytes_by_resolution()[60] >= 2 * 480
+    # nothing got dropped, cold hours are still there at a coarser resolution
+    assert not cache.intervals_be_updated(day, day + 12 * 3600, 3600)
+    assert cache.get(day, day + 12 * 3600, 3600) == pytest.approx(
+        [np.mean(data) for data in datas])
+    # the viewport is untouched
+    assert cache.get(day + 10 * 3600, day + 12 * 3600, 60) == datas[10] + datas[11]
+
+def test_store_files_span_only_the_data(tmp_path):
+    now = util.epoch('2024-06-01 00:00:00')
+    store = store_mod.MmapStore(tmp_path)
+    store.write(now, now + 3600, 60, np.arange(60.0))
+    store.write(now + 3600, now + 7200, 60, np.arange(60.0, 120.0))
+    # from the tile of the first write on, not from the epoch
+    assert os.path.getsize(tmp_path / '60.f64') == 8 * 120
+
+    # data before the first write is kept as well
+    store.write(now - 7200, now - 3600, 60, np.arange(-120.0, -60.0))
+    assert store.covered(now - 7200, now + 7200, 60) == [
+        (now - 7200, now - 3600), (now, now + 7200)]
+    np.testing.assert_array_equal(store.read(now, now + 7200, 60), np.arange(120.0))
+    np.testing.assert_array_equal(store.read(now - 7200, now - 3600, 60),
+                                  np.arange(-120.0, -60.0))
+    assert os.path.getsize(tmp_path / '60.f64') < 8 * 24 * 60
+
+    store.flush()
+    reopened = store_mod.MmapStore(tmp_path)
+    assert reopened.covered(now - 7200, now + 7200, 60) == store.covered(
+        now - 7200, now + 7200, 60)
+    np.testing.assert_array_equal(reopened.read(now - 7200, now - 3600, 60),
+                                  np.arange(-120.0, -60.0))
+
+
+@pytest.mark.parametrize('cache_cls', [cc.ChartCache, cc.SortedChartCache])
+def test_store_writes_and_reads_through(tmp_path, cache_cls):
+    am_9, am_10, am_11 = (util.epoch(f'2000-01-01 {h}:00:00') for h in (9, 10, 11))
+    cache = cache_cls(store=store_mod.MmapStore(tmp_path))
+    cache.merge(am_9, am_10, 60, temperature_data_lst(60))
+    cache.merge(am_10, am_11, 300, temperature_data_lst(12))
+    # the index is written once, on flush, not on every merge
+    assert not (tmp_path / store_mod.MmapStore.INDEX).exists()
+    cache.store.flush()
+
+    # a fresh cache over the same files, e.g. after a restart
+    reopened = cache_cls(store=store_mod.MmapStore(tmp_path))
+    assert reopened.intervals_be_updated(am_9, am_11, 60) == [(am_10, am_11, 60)]
+    assert reopened.get(am_9, am_11, 60) == cache.get(am_9, am_11, 60)
+    assert reopened.get(am_9, am_11, 300) == cache.get(am_9, am_11, 300)
+    assert reopened.intervals_be_updated(am_11, am_11 + 3600, 60) == [
+        (am_11, am_11 + 3600, 60)]
+
+
+@pytest.mark.parametrize('cache_cls', [cc.ChartCache, cc.SortedChartCache])
+@pytest.mark.parametrize('mmap', [False, True])
+def test_save_and_load(tmp_path, cache_cls, mmap):
+    am_9, am_10, am_11 = (util.epoch(f'2000-01-01 {h}:00:00') for h in (9, 10, 11))
+    cache = cache_cls()
+    cache.merge(am_9, am_10, 60, temperature_data_lst(60))
+    cache.merge(am_10, am_11, 300, temperature_data_lst(12))
+    cache.merge(am_11 + 3600, am_11 + 7200, 3600, temperature_data_lst(1))
+    cache.save(tmp_path / 'cache.npz')
+
+    loaded = cache_cls.load(tmp_path / 'cache.npz', mmap=mmap)
+    assert [p[:2] for p in loaded.all_periods()] == [p[:2] for p in cache.all_periods()]
+    for resolution in (0, 60, 300, 3600):
+        assert loaded.get(am_9, am_11 + 7200, resolution) == cache.get(
+            am_9, am_11 + 7200, resolution)
+    for resolution in (60, 300, 3600):
+        assert loaded.intervals_be_updated(am_9 - 3600, am_11 + 7200, resolution) == \
+            cache.intervals_be_updated(am_9 - 3600, am_11 + 7200, resolution)
+    assert loaded.nbytes_by_resolution() == cache.nbytes_by_resolution()
+
+
+def test_load_restores_rollups_without_reading_periods(tmp_path, monkeypatch):
+    day = util.epoch('2000-01-01 00:00:00')
+    cache = cc.SortedChartCache()
+    cache.merge(day, day + 24 * 3600, 60, temperature_data_lst(24 * 60))
+    cache.save(tmp_path / 'cache.npz')
+
+    def accumulate(*args):
+        raise AssertionError('rollups recomputed from the periods')
+    monkeypatch.setattr(cc.IntervalData, 'accumulate', accumulate)
+    loaded = cc.SortedChartCache.load(tmp_path / 'cache.npz', mmap=True)
+    for resolution, level in cache.rollups.items():
+        assert sorted(loaded.rollups[resolution].blocks) == sorted(level.blocks)
+    assert loaded.get(day, day + 24 * 3600, 3600) == cache.get(day, day + 24 * 3600, 3600)
+
+
+def test_tiles(state_0am_10am_fixture):
+    am_0, am_10, cache = state_0am_10am_fixture
+    am_12 = util.epoch('2000-01-01 12:00:00')
+    # 0am to 10am is there in 5 minutes, 10am to noon is missing
+    assert cache.tiles_be_updated(am_0, am_12, 300) == [(300, am_12 // util.SECONDS_IN_DAY)]
+    assert cache.tiles_be_updated(am_0, util.epoch(am_10), 60) == [
+        (60, util.epoch(am_0) // (6 * util.SECONDS_IN_HOUR) + i) for i in range(2)]
+
+    key = (60, am_12 // (6 * util.SECONDS_IN_HOUR))
+    assert util.tile_range(key) == (am_12, am_12 + 6 * util.SECONDS_IN_HOUR, 60)
+    data = temperature_data_lst(360)
+    cache.merge_tile(key, data)
+    assert cache.get_tile(key).tolist() == data
+    assert not cache.tiles_be_updated(am_12, am_12 + 3600, 60)
+
 # ======================================= End Chart Cache=================================
 
 # ====================================== Controller ======================================
@@ -426,24 +694,25 @@ async def test_set_endtimie_twice_out_of_order_recev(state_1am_to_1am_plus_1mo_f
     # next task id wil be
     assert controller.cur_tid == 2
 
-    # set request #2: (1am, 3am)
-    am_3 = util.time_stamp('''2000-01-01 03:00:00''')
-    await controller.set_end_time(util.epoch(am_3))
+    # set request #2: (1am, 1am + 40 days), it doesn't need any of what #1 is waiting for
+    am_1_plus_40d = am_1 + pd.Timedelta(days=40)
+    await controller.set_end_time(util.epoch(am_1_plus_40d))
     assert backend.last_request == (
-        util.epoch(am_1),
-        util.epoch(am_3),
-        300
+        util.epoch(am_1_plus_1mo),
+        util.epoch(am_1_plus_40d),
+        3600
     )
     # next task id wil be
     assert controller.cur_tid == 3
 
     # recevies data for the 2nd request
-    data_2nd_req = temperature_data_lst(24)
+    data_2nd_req = temperature_data_lst(9 * 24)
     controller.receive_temperature_data(
-        util.epoch(am_1), util.epoch(am_3), 300, data_2nd_req
+        util.epoch(am_1_plus_1mo), util.epoch(am_1_plus_40d), 3600, data_2nd_req
     )
     # renders for 2nd request
-    assert ui.datapoints == data_2nd_req
+    rendered_2nd_req = ui.datapoints
+    assert len(rendered_2nd_req) == 40 * 24 and rendered_2nd_req[-9 * 24:] == data_2nd_req
 
     ui_mod_time_before_recv = ui.last_mod
     data_1st_req = temperature_data_lst(60)
@@ -451,15 +720,573 @@ async def test_set_endtimie_twice_out_of_order_recev(state_1am_to_1am_plus_1mo_f
         util.epoch(am_1), util.epoch(am_2), 60, data_1st_req
     )
     # no render triggered by this receipt
-    assert ui.datapoints == data_2nd_req and ui_mod_time_before_recv == ui.last_mod
+    assert ui.datapoints == rendered_2nd_req and ui_mod_time_before_recv == ui.last_mod
     backend_mod_before = backend.last_mod
-    assert len(controller.cache.get(
-        am_1, am_3, 300
-    )) == 24
+    assert controller.cache.get(am_1, am_2, 60) == data_1st_req
     # didn't go to backend for these data
     assert backend.last_mod == backend_mod_before
 
 
+@pytest.mark.asyncio
+async def test_set_end_time_covered_by_pending_request(state_1am_to_1am_plus_1mo_fixture):
+    '''set request #2 needs (1am, 3am) in 5 minutes, but (1am, 2am) in 1 minute is already
+    pending for #1; only (2am, 3am) gets requested and #1's data renders for #2 when it arrives
+    '''
+    am_1, am_1_plus_1mo, cache = state_1am_to_1am_plus_1mo_fixture
+    backend = backend_mod.MockBackend()
+    ui = ui_mod.MockUI()
+    controller = await controller_mod.Controller.create(
+        ui, backend, util.epoch(am_1), util.epoch(am_1_plus_1mo), cache)
+    am_2 = util.time_stamp('''2000-01-01 02:00:00''')
+    am_3 = util.time_stamp('''2000-01-01 03:00:00''')
+    await controller.set_end_time(util.epoch(am_2))
+    await controller.set_end_time(util.epoch(am_3))
+    assert backend.last_request == (util.epoch(am_2), util.epoch(am_3), 300)
+
+    data_2nd_req = temperature_data_lst(12)
+    controller.receive_temperature_data(util.epoch(am_2), util.epoch(am_3), 300, data_2nd_req)
+    assert len(ui.datapoints) == 24 and ui.datapoints[12:] == data_2nd_req
+
+    data_1st_req = temperature_data_lst(60)
+    controller.receive_temperature_data(util.epoch(am_1), util.epoch(am_2), 60, data_1st_req)
+    assert ui.datapoints == util.scaled_data(data_1st_req, 60, 300) + data_2nd_req
+
+
+@pytest.mark.asyncio
+async def test_create_with_sorted_cache():
+    backend = backend_mod.MockBackend()
+    ui = ui_mod.MockUI()
+    start_time = util.epoch('2000-01-01 13:00:00')
+    end_time = util.epoch('2000-01-01 14:00:00')
+    controller = await controller_mod.Controller.create(
+        ui, backend, start_time, end_time, cache_cls=cc.SortedChartCache)
+    assert isinstance(controller.cache, cc.SortedChartCache)
+
+    data = temperature_data_lst(60)
+    controller.receive_temperature_data(start_time, end_time, 60, data)
+    assert ui.datapoints == data
+
+
+class RespondingBackend:
+    '''Returns the data from request_temperature_data after a delay, and keeps track of how
+    many requests were in flight at once'''
+
+    def __init__(self):
+        self.requests = []
+        self.cancelled = []
+        self.inflight = 0
+        self.max_inflight = 0
+
+    async def request_temperature_data(self, start_time, end_time, resolution):
+        self.requests.append((start_time, end_time, resolution))
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            self.cancelled.append((start_time, end_time, resolution))
+            raise
+        finally:
+            self.inflight -= 1
+        return temperature_data_lst(util.num_datapoints(end_time - start_time, resolution))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('max_inflight', [2, 4])
+async def test_set_end_time_fetches_concurrently(max_inflight):
+    backend = RespondingBackend()
+    ui = ui_mod.MockUI()
+    cache = cc.ChartCache()
+    for start, end in [('13:00', '13:10'), ('13:20', '13:30'), ('13:40', '13:50')]:
+        cache.merge(util.epoch(f'2000-01-01 {start}:00'), util.epoch(f'2000-01-01 {end}:00'),
+                    60, temperature_data_lst(10))
+    controller = await controller_mod.Controller.create(
+        ui, backend, util.epoch('2000-01-01 13:00:00'), util.epoch('2000-01-01 13:10:00'),
+        cache, max_inflight=max_inflight)
+    backend.requests = []
+
+    await controller.set_end_time(util.epoch('2000-01-01 14:00:00'))
+    assert sorted(backend.requests) == [
+        (util.epoch(f'2000-01-01 {start}:00'), util.epoch(f'2000-01-01 {end}:00'), 60)
+        for start, end in [('13:10', '13:20'), ('13:30', '13:40'), ('13:50', '14:00')]]
+    assert backend.max_inflight == min(max_inflight, 3)
+    # every response got merged and rendered
+    assert len(ui.datapoints) == 60 and None not in ui.datapoints
+
+
+class RangeRecordingUI(ui_mod.MockUI):
+
+    def __init__(self):
+        self.ranges = []
+
+    def set_chart_data_range(self, offset, datapoints):
+        self.ranges.append((offset, len(datapoints)))
+        super().set_chart_data_range(offset, datapoints)
+
+
+class FullRenderUI:
+    '''A UI without set_chart_data_range'''
+
+    def set_chart_data(self, datapoints):
+        self.datapoints = datapoints
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('ui_cls', [RangeRecordingUI, FullRenderUI])
+async def test_responses_render_changed_datapoints_only(ui_cls):
+    backend = RespondingBackend()
+    ui = ui_cls()
+    cache = cc.ChartCache()
+    for start, end in [('13:00', '13:10'), ('13:20', '13:30'), ('13:40', '13:50')]:
+        cache.merge(util.epoch(f'2000-01-01 {start}:00'), util.epoch(f'2000-01-01 {end}:00'),
+                    60, temperature_data_lst(10))
+    controller = await controller_mod.Controller.create(
+        ui, backend, util.epoch('2000-01-01 13:00:00'), util.epoch('2000-01-01 13:10:00'),
+        cache)
+    ui.ranges = []
+
+    await controller.set_end_time(util.epoch('2000-01-01 14:00:00'))
+    if ui_cls is RangeRecordingUI:
+        assert sorted(ui.ranges) == [(10, 10), (30, 10), (50, 10)]
+    assert len(ui.datapoints) == 60 and None not in ui.datapoints
+    assert ui.datapoints == cache.get(
+        util.epoch('2000-01-01 13:00:00'), util.epoch('2000-01-01 14:00:00'), 60)
+
+
+class FailingOnceBackend(RespondingBackend):
+    '''Fails the first request'''
+
+    async def request_temperature_data(self, start_time, end_time, resolution):
+        if not self.requests:
+            self.requests.append((start_time, end_time, resolution))
+            raise ConnectionError('backend unavailable')
+        return await super().request_temperature_data(start_time, end_time, resolution)
+
+
+@pytest.mark.asyncio
+async def test_failed_request_is_logged_and_requested_again(caplog):
+    backend = FailingOnceBackend()
+    ui = ui_mod.MockUI()
+    day = util.epoch('2000-01-01 00:00:00')
+    controller = await controller_mod.Controller.create(ui, backend, day, day + 3600)
+    assert any(record.exc_info and record.exc_info[0] is ConnectionError
+               for record in caplog.records)
+    assert controller.bookkeeping_sizes['backend_reqs'] == 0
+
+    # nothing is left pending for the new viewport to be coalesced onto
+    await controller.set_range(day + 1800, day + 5400)
+    assert backend.requests[1:] == [(day + 1800, day + 5400, 60)]
+    assert len(ui.datapoints) == 60 and None not in ui.datapoints
+
+
+@pytest.mark.asyncio
+async def test_superseded_requests_get_cancelled():
+    backend = RespondingBackend()
+    ui = ui_mod.MockUI()
+    cache = cc.ChartCache()
+    for start, end in [('13:00', '13:10'), ('13:20', '13:30'), ('13:40', '13:50')]:
+        cache.merge(util.epoch(f'2000-01-01 {start}:00'), util.epoch(f'2000-01-01 {end}:00'),
+                    60, temperature_data_lst(10))
+    controller = await controller_mod.Controller.create(
+        ui, backend, util.epoch('2000-01-01 13:00:00'), util.epoch('2000-01-01 13:10:00'),
+        cache, max_inflight=1)
+    backend.requests = []
+
+    # 3 requests, 1 in flight and 2 waiting for it
+    set_end_time = asyncio.ensure_future(
+        controller.set_end_time(util.epoch('2000-01-01 14:00:00')))
+    await asyncio.sleep(0.001)
+    assert len(backend.requests) == 1
+    # a viewport that needs none of them
+    await controller.set_start_time(util.epoch('2000-01-01 13:05:00'))
+    await set_end_time
+
+    assert controller.cancelled_requests == 3
+    assert backend.cancelled == backend.requests
+    assert len(backend.requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_superseded_request_cancelled_in_backend(state_with_1pm_to_2pm_fixture):
+    backend, ui, controller = state_with_1pm_to_2pm_fixture
+    await controller.set_end_time(util.epoch('2000-01-01 14:30:00'))
+    pending = backend.last_request
+    await controller.set_end_time(util.epoch('2000-01-01 13:30:00'))
+    assert backend.last_cancelled == pending
+
+
+@pytest.mark.asyncio
+async def test_prefetch_ahead_of_pan():
+    backend = backend_mod.MockBackend()
+    ui = ui_mod.MockUI()
+    prefetcher = prefetch_mod.Prefetcher(budget=2)
+    start_time = util.epoch('2000-01-01 13:00:00')
+    end_time = util.epoch('2000-01-01 14:00:00')
+    controller = await controller_mod.Controller.create(
+        ui, backend, start_time, end_time, prefetcher=prefetcher)
+    controller.receive_temperature_data(start_time, end_time, 60, temperature_data_lst(60))
+
+    await controller.set_end_time(util.epoch('2000-01-01 14:30:00'))
+    # let the prefetches go out
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert prefetcher.stats['issued'] == 2
+    # the next window in the direction of the pan, and the gap to zoom out once more
+    assert sorted(controller.prefetching) == [
+        (util.epoch('2000-01-01 12:15:00'), util.epoch('2000-01-01 13:00:00'), 300),
+        (util.epoch('2000-01-01 14:30:00'), util.epoch('2000-01-01 16:00:00'), 60),
+    ]
+    controller.receive_temperature_data(
+        util.epoch('2000-01-01 14:00:00'), util.epoch('2000-01-01 14:30:00'), 60,
+        temperature_data_lst(30))
+    controller.receive_temperature_data(
+        util.epoch('2000-01-01 14:30:00'), util.epoch('2000-01-01 16:00:00'), 60,
+        temperature_data_lst(90))
+
+    await controller.set_end_time(util.epoch('2000-01-01 15:30:00'))
+    # rendered entirely from the prefetched data
+    assert len(ui.datapoints) == 30 and None not in ui.datapoints
+    assert prefetcher.stats['hits'] == 1
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+class FailingBackend(RespondingBackend):
+    '''Fails every request'''
+
+    async def request_temperature_data(self, start_time, end_time, resolution):
+        self.requests.append((start_time, end_time, resolution))
+        raise ConnectionError('backend unavailable')
+
+
+@pytest.mark.asyncio
+async def test_failed_prefetch_is_wasted_and_frees_the_budget(caplog):
+    prefetcher = prefetch_mod.Prefetcher(budget=2)
+    day = util.epoch('2000-01-01 00:00:00')
+    controller = await controller_mod.Controller.create(
+        ui_mod.MockUI(), FailingBackend(), day, day + 3600, prefetcher=prefetcher)
+    await controller.set_range(day + 1800, day + 5400)
+    assert prefetcher.stats['issued'] == 1
+    # let the prefetch go out and fail
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert prefetcher.stats['wasted'] == 1
+    assert not controller.prefetching
+    assert any(record.getMessage() == 'Prefetching data failed' for record in caplog.records)
+
+
+@pytest.mark.asyncio
+async def test_tiled_requests():
+    backend = backend_mod.MockBackend()
+    ui = ui_mod.MockUI()
+    start_time = util.epoch('2000-01-01 13:00:00')
+    end_time = util.epoch('2000-01-01 14:00:00')
+    controller = await controller_mod.Controller.create(
+        ui, backend, start_time, end_time, tiled=True)
+    # the whole 6 hour tile the viewport is in
+    tile = (util.epoch('2000-01-01 12:00:00'), util.epoch('2000-01-01 18:00:00'), 60)
+    assert backend.last_request == tile
+
+    data = temperature_data_lst(360)
+    controller.receive_temperature_data(*tile, data)
+    assert ui.datapoints == data[60:120]
+
+    backend_last_mod = backend.last_mod
+    await controller.set_end_time(util.epoch('2000-01-01 14:30:00'))
+    assert ui.datapoints == data[60:150]
+    assert backend.last_mod == backend_last_mod
+
+
+@pytest.mark.asyncio
+async def test_bookkeeping_stays_bounded():
+    backend = RespondingBackend()
+    ui = ui_mod.MockUI()
+    start_time = util.epoch('2000-01-01 13:00:00')
+    controller = await controller_mod.Controller.create(
+        ui, backend, start_time, start_time + 600)
+    for minutes in range(20, 220, 10):
+        await controller.set_end_time(start_time + minutes * 60)
+        assert controller.bookkeeping_sizes['ui_reqs'] <= 2
+        assert controller.bookkeeping_sizes['backend_reqs'] == 0
+    assert len(backend.requests) == 21
+
+    # what's in flight stays tracked until it's done
+    set_end_time = asyncio.ensure_future(controller.set_end_time(start_time + 230 * 60))
+    await asyncio.sleep(0.001)
+    assert controller.bookkeeping_sizes['backend_reqs'] == 1
+    await set_end_time
+    assert controller.bookkeeping_sizes['backend_reqs'] == 0
+
+
+@pytest.mark.asyncio
+async def test_new_viewport_pinned_while_its_data_arrives():
+    # the rollup blocks of a day take 7296 bytes, an hour of minutes 480
+    cache = cc.SortedChartCache(max_bytes=7296 + 1000)
+    day = util.epoch('2000-01-01 00:00:00')
+    cache.merge(day + 15 * 3600, day + 16 * 3600, 60, temperature_data_lst(60))
+    controller = await controller_mod.Controller.create(
+        ui_mod.MockUI(), RespondingBackend(), day + 13 * 3600, day + 14 * 3600, cache)
+
+    await controller.set_range(day + 15 * 3600, day + 17 * 3600)
+    assert cache.intervals_be_updated(day + 15 * 3600, day + 17 * 3600, 300) == []
+
+
+class ThreadRecordingCache(cc.SortedChartCache):
+
+    def read_stored(self, pieces):
+        self.read_in = threading.current_thread()
+        return super().read_stored(pieces)
+
+
+@pytest.mark.asyncio
+async def test_evicted_data_spills_to_store_and_is_read_off_the_loop(tmp_path):
+    backend = RespondingBackend()
+    ui = ui_mod.MockUI()
+    # the rollup blocks of a day take 7296 bytes, an hour of minutes 480
+    cache = ThreadRecordingCache(
+        max_bytes=7296 + 1000, store=store_mod.MmapStore(tmp_path), write_through=False)
+    day = util.epoch('2000-01-01 00:00:00')
+    controller = await controller_mod.Controller.create(
+        ui, backend, day + 13 * 3600, day + 14 * 3600, cache)
+    first_hour = ui.datapoints
+    for hour in (15, 17, 19):
+        await controller.set_range(day + hour * 3600, day + (hour + 1) * 3600)
+    assert cache.periods(day + 13 * 3600, day + 14 * 3600) == []
+    backend.requests = []
+
+    await controller.set_range(day + 13 * 3600, day + 14 * 3600)
+    assert backend.requests == []
+    assert ui.datapoints == first_hour
+    assert cache.read_in is not threading.main_thread()
+
+
+class ThreadRecordingStore(store_mod.MmapStore):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_in = []
+
+    def read(self, start, end, resolution):
+        self.read_in.append(threading.current_thread())
+        return super().read(start, end, resolution)
+
+
+@pytest.mark.parametrize('tiled', [False, True])
+@pytest.mark.asyncio
+async def test_store_read_off_the_loop_for_prefetches_and_tiles(tmp_path, tiled):
+    day = util.epoch('2000-01-01 00:00:00')
+    store = ThreadRecordingStore(tmp_path)
+    store.write(day, day + 24 * 3600, 60, np.arange(24 * 60.0))
+    backend = RespondingBackend()
+    cache = cc.SortedChartCache(store=store)
+    controller = await controller_mod.Controller.create(
+        ui_mod.MockUI(), backend, day + 3600, day + 7200, cache,
+        prefetcher=prefetch_mod.Prefetcher(), tiled=tiled)
+    backend.requests = []
+    await controller.set_range(day + 5400, day + 9000)
+    # the viewport, the rest of its tiles and the prefetched window all came from the store
+    assert backend.requests == []
+    assert not cache.intervals_be_updated(day + 9000, day + 12600, 60, read_through=False)
+    assert store.read_in
+    assert all(thread is not threading.main_thread() for thread in store.read_in)
+
+
+class ReadRecordingCache(cc.ChartCache):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = []
+
+    def get_into(self, start_time, end_time, data_resolution, out, read_through=True):
+        self.reads.append((start_time, end_time))
+        super().get_into(start_time, end_time, data_resolution, out, read_through)
+
+
+def test_render_buffer_pans_in_place():
+    cache = ReadRecordingCache()
+    cache.merge(util.epoch('2000-01-01 13:00:00'), util.epoch('2000-01-01 14:00:00'),
+                60, temperature_data_lst(60))
+    buffer = render_mod.RenderBuffer(cache)
+    buffer.move(util.epoch('2000-01-01 12:30:00'), util.epoch('2000-01-01 13:30:00'), 60)
+    array = buffer.values.base
+
+    for start, end in [('12:50', '13:50'), ('12:40', '13:40'), ('13:10', '14:10')]:
+        cache.reads = []
+        buffer.move(util.epoch(f'2000-01-01 {start}:00'), util.epoch(f'2000-01-01 {end}:00'), 60)
+        assert buffer.values.base is array
+        assert buffer.tolist() == cache.get(
+            util.epoch(f'2000-01-01 {start}:00'), util.epoch(f'2000-01-01 {end}:00'), 60)
+    # only the datapoints that came into view got read
+    assert cache.reads == [(util.epoch('2000-01-01 13:40:00'), util.epoch('2000-01-01 14:10:00'))]
+
+    cache.merge(util.epoch('2000-01-01 14:00:00'), util.epoch('2000-01-01 14:05:00'),
+                60, temperature_data_lst(5))
+    assert buffer.refresh(
+        util.epoch('2000-01-01 14:00:00'), util.epoch('2000-01-01 14:05:00')) == (50, 55)
+    assert None not in buffer.tolist(0, 55) and buffer.tolist(55) == [None] * 5
+
+
+def test_m4_keeps_first_min_max_last_per_pixel():
+    times = np.arange(0, 1200, 60)
+    values = np.full(20, 20.0)
+    values[[3, 7, 12]] = [35, 5, 30]
+    values[15:] = np.nan
+    present = ~np.isnan(values)
+    reduced = render_mod.m4(times[present], values[present], 0, 1200, 3)
+    # columns of 400 seconds hold 7, 7 and 1 datapoints; the min and max keep their order
+    np.testing.assert_array_equal(
+        reduced, [20, 20, 35, 20] + [5, 5, 30, 20] + [20, 20, 20, 20])
+
+
+@pytest.mark.asyncio
+async def test_pixel_width_renders_m4_of_cached_data():
+    backend = RespondingBackend()
+    ui = ui_mod.MockUI()
+    cache = cc.ChartCache()
+    data = temperature_data_lst(24 * 60)
+    data[100] = 100
+    cache.merge(util.epoch('2000-01-01 00:00:00'), util.epoch('2000-01-02 00:00:00'), 60, data)
+    await controller_mod.Controller.create(
+        ui, backend, util.epoch('2000-01-01 00:00:00'), util.epoch('2000-01-02 00:00:00'),
+        cache, pixel_width=50)
+    assert len(ui.datapoints) == 200
+    # the 5 minute means would have flattened the spike
+    assert max(ui.datapoints) == 100
+
+
+@pytest.mark.asyncio
+async def test_pixel_width_keeps_gaps_in_place():
+    day = util.epoch('2000-01-01 00:00:00')
+    cache = cc.ChartCache()
+    # nothing from 8am to 4pm
+    cache.merge(day, day + 8 * 3600, 60, temperature_data_lst(8 * 60))
+    cache.merge(day + 16 * 3600, day + 24 * 3600, 60, temperature_data_lst(8 * 60))
+    ui = ui_mod.MockUI()
+    await controller_mod.Controller.create(
+        ui, backend_mod.MockBackend(), day, day + 24 * 3600, cache, pixel_width=50)
+    # columns of 1728 seconds, the 17th to the 32nd hold none of the data
+    assert len(ui.datapoints) == 4 * 50
+    assert ui.datapoints[4 * 17:4 * 33] == [None] * 4 * 16
+    assert None not in ui.datapoints[:4 * 17] + ui.datapoints[4 * 33:]
+
+    # 5 minute datapoints fit 4 per column at 100 pixels, and are rendered as they are
+    ui = ui_mod.MockUI()
+    await controller_mod.Controller.create(
+        ui, backend_mod.MockBackend(), day, day + 24 * 3600, cache, pixel_width=100)
+    assert len(ui.datapoints) == 24 * 12
+    assert ui.datapoints[8 * 12:16 * 12] == [None] * 8 * 12
+    assert None not in ui.datapoints[:8 * 12] + ui.datapoints[16 * 12:]
+
+
+class CountingUI(ui_mod.MockUI):
+
+    def __init__(self):
+        self.renders = 0
+
+    def set_chart_data(self, datapoints):
+        self.renders += 1
+        super().set_chart_data(datapoints)
+
+
+@pytest.mark.asyncio
+async def test_renders_coalesced_within_frame():
+    backend = RespondingBackend()
+    ui = CountingUI()
+    cache = cc.ChartCache()
+    for start, end in [('13:00', '13:10'), ('13:20', '13:30'), ('13:40', '13:50')]:
+        cache.merge(util.epoch(f'2000-01-01 {start}:00'), util.epoch(f'2000-01-01 {end}:00'),
+                    60, temperature_data_lst(10))
+    controller = await controller_mod.Controller.create(
+        ui, backend, util.epoch('2000-01-01 13:00:00'), util.epoch('2000-01-01 13:10:00'),
+        cache, frame_interval=0.2)
+    await asyncio.sleep(0.5)
+    renders = ui.renders
+    dropped = controller.dropped_renders
+
+    # the immediate render, then 3 responses arriving together within the next frame
+    await controller.set_end_time(util.epoch('2000-01-01 14:00:00'))
+    await asyncio.sleep(0.3)
+    assert ui.renders - renders == 2
+    assert controller.dropped_renders - dropped == 2
+    # the render that made it is the most up-to-date one
+    assert len(ui.datapoints) == 60 and None not in ui.datapoints
+
+
+def test_render_outside_event_loop_is_not_deferred():
+    ui = CountingUI()
+    scheduler = render_mod.RenderScheduler(ui, frame_interval=60)
+    # e.g. a backend calling back from its own thread, with no loop to wait for the frame on
+    scheduler.render(0, [1.0])
+    scheduler.render(1, [2.0])
+    assert ui.renders == 2 and ui.datapoints == [2.0]
+
+
+@pytest.mark.asyncio
+async def test_set_range_plans_final_viewport_only():
+    backend = RespondingBackend()
+    ui = CountingUI()
+    cache = cc.ChartCache()
+    cache.merge(util.epoch('2000-01-01 13:00:00'), util.epoch('2000-01-01 14:00:00'),
+                60, temperature_data_lst(60))
+    controller = await controller_mod.Controller.create(
+        ui, backend, util.epoch('2000-01-01 13:00:00'), util.epoch('2000-01-01 13:30:00'),
+        cache)
+    backend.requests = []
+    renders = ui.renders
+
+    # pan within what's cached
+    await controller.set_range(util.epoch('2000-01-01 13:20:00'),
+                               util.epoch('2000-01-01 13:50:00'))
+    assert backend.requests == []
+    assert ui.renders - renders == 1
+    assert ui.datapoints == cache.get(
+        util.epoch('2000-01-01 13:20:00'), util.epoch('2000-01-01 13:50:00'), 60)
+
+    # zoom out past both ends
+    await controller.set_range(util.epoch('2000-01-01 12:00:00'),
+                               util.epoch('2000-01-01 16:00:00'))
+    assert (controller.start_time, controller.end_time) == (
+        util.epoch('2000-01-01 12:00:00'), util.epoch('2000-01-01 16:00:00'))
+    assert sorted(backend.requests) == [
+        (util.epoch('2000-01-01 12:00:00'), util.epoch('2000-01-01 13:00:00'), 300),
+        (util.epoch('2000-01-01 14:00:00'), util.epoch('2000-01-01 16:00:00'), 300)]
+    assert len(ui.datapoints) == 48 and None not in ui.datapoints
+
+
+@pytest.mark.asyncio
+async def test_events_are_sampled_summaries(caplog, monkeypatch):
+    async def pan(controller, hours):
+        for hour in hours:
+            await controller.set_range(day + hour * 3600, day + (hour + 1) * 3600)
+
+    day = util.epoch('2000-01-01 00:00:00')
+    controller = await controller_mod.Controller.create(
+        ui_mod.MockUI(), RespondingBackend(), day, day + 3600)
+
+    # disabled, nothing is even put together
+    caplog.set_level(logging.INFO, logger='events')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('logged while disabled')
+    monkeypatch.setattr(events, 'log', fail)
+    await pan(controller, [1, 2])
+    monkeypatch.undo()
+
+    caplog.set_level(logging.DEBUG, logger='events')
+    await pan(controller, [3])
+    logged = {record.event: record.fields for record in caplog.records}
+    assert {'render', 'fetch', 'merge', 'receive'} <= set(logged)
+    assert logged['receive']['datapoints'] == 60
+    assert all(len(record.getMessage()) < 200 for record in caplog.records)
+
+    caplog.clear()
+    monkeypatch.setattr(events, 'sample_rate', 0)
+    await pan(controller, [4, 5])
+    assert not caplog.records
+    with pytest.raises(ValueError):
+        events.set_sample_rate(2)
+
+
 # ====================================== End Controller ==============================
 
 # =========================================== UTIL =====================================
@@ -497,8 +1324,47 @@ def test_scaled_data_throws_when_invalid_resolution():
     with pytest.raises(ValueError):
         util.scaled_data(temperatures, old_resolution, wrong_new_resolution2)
 
+def test_scaled_data_skips_missing():
+    temperatures = [20, None, 22, None, None, None, 21, None, 26]
+    assert util.scaled_data(temperatures, 60, 300) == [21, 23.5]
+    assert util.scaled_data(temperatures[:5], 60, 300) == [21]
+    assert util.scaled_data([None] * 5, 60, 300) == [None]
+    assert util.scaled_data([20, None], 300, 60) == [20] * 5 + [None] * 5
+
+
+@pytest.mark.parametrize('how, expected', [
+    ('mean', [21, np.nan, 23.5]),
+    ('min', [20, np.nan, 21]),
+    ('max', [22, np.nan, 26]),
+    ('last', [22, np.nan, 21]),
+    ('count', [2, 0, 2]),
+])
+def test_rolledup_array_aggregations(how, expected):
+    temperatures = np.array([20, np.nan, 22, np.nan, np.nan, np.nan, 26, np.nan, 21])
+    rolled_up, coverage = util.rolledup_array(temperatures, 3, how)
+    np.testing.assert_array_equal(rolled_up, expected)
+    np.testing.assert_array_equal(coverage, [2 / 3, 0, 2 / 3])
+
+
 # ==========================================END UTIL ======================================
 
+def test_import_has_no_side_effects():
+    check = ('import logging, sys, controller, backend, ui; '
+             'ui.MockUI().set_chart_data([]); ui.MockUI().set_chart_data_range(0, []); '
+             'print("pandas" in sys.modules, logging.getLogger().handlers)')
+    output = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    # pandas only gets imported once Timestamps are used, and logging is left as it is, even
+    # after rendering
+    assert output.split() == ['False', '[]']
+
+    # the modules only doing arithmetic on times don't need numpy
+    check = 'import sys, backend, prefetch; print("numpy" in sys.modules)'
+    output = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    assert output.split() == ['False']
+
+
 # ================================ DEMO ==========================================
 @pytest.mark.asyncio
 async def test_demo():
@@ -726,14 +1592,14 @@ async def test_demo():
     am_2 = util.time_stamp('''2000-01-01 02:00:00''')
     await controller.set_end_time(util.epoch(am_2))
 
-    # set end time request #B: (1am, 3am)
-    am_3 = util.time_stamp('''2000-01-01 03:00:00''')
-    await controller.set_end_time(util.epoch(am_3))
+    # set end time request #B: (1am, 1am + 40 days)
+    am_1_plus_40d = am_1 + pd.Timedelta(days=40)
+    await controller.set_end_time(util.epoch(am_1_plus_40d))
 
     # controller recevies data for the request #B first
-    data_2nd_req = temperature_data_lst(24)
+    data_2nd_req = temperature_data_lst(9 * 24)
     controller.receive_temperature_data(
-        util.epoch(am_1), util.epoch(am_3), 300, data_2nd_req
+        util.epoch(am_1_plus_1mo), util.epoch(am_1_plus_40d), 3600, data_2nd_req
     )
 
     # note there was a rendering as usual
@@ -746,6 +1612,9 @@ async def test_demo():
 
     # this time, there was no rendering
 
+    # Had request #B needed (1am, 2am) as well, it wouldn't have requested it again: it'd have
+    # waited on request #A's data and rendered it when it arrived
+
     # the end, thank you
 
 
@@ -1,7 +1,8 @@
 import logging
 import time
 
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
 
 class MockUI:
     '''Renders a chart on screen with the given datapoints, which are simply an
@@ -30,8 +31,18 @@ class MockUI:
 
     def set_chart_data(self, datapoints):
         self.datapoints = datapoints
-        logging.debug('''set_chart_data: %s datapoints rendered=%s''',
-                      len(datapoints), datapoints)
+        # a summary only, formatting thousands of datapoints is slow
+        logger.debug('''set_chart_data: %s datapoints rendered''', len(datapoints))
+
+    def set_chart_data_range(self, offset, datapoints):
+        '''Replaces the datapoints from offset on with datapoints, leaving the rest of the
+        chart as it is. Optional for a UI; the controller uses set_chart_data without it.
+        '''
+        rendered = list(self.datapoints)
+        rendered[offset:offset + len(datapoints)] = datapoints
+        self.datapoints = rendered
+        logger.debug('''set_chart_data_range: %s datapoints rendered at %s''',
+                     len(datapoints), offset)
 
     @property
     def last_mod(self):
@@ -1,7 +1,4 @@
-import chart_cache as cc
-import intervaltree
-import pandas as pd
-import statistics as stats
+import numbers
 
 
 VALID_RESOLUTIONS = {60, 300, 3600}
@@ -9,9 +6,24 @@ SECONDS_IN_MIN = 60
 SECONDS_IN_HOUR = 60 * SECONDS_IN_MIN
 SECONDS_IN_DAY = 24 * SECONDS_IN_HOUR
 SECONDS_IN_WEEK = 7 * SECONDS_IN_DAY
+NANOSECONDS_IN_SECOND = 10 ** 9
+# how many seconds of data a tile holds at each resolution
+TILE_SECONDS = {
+    SECONDS_IN_MIN: 6 * SECONDS_IN_HOUR,
+    5 * SECONDS_IN_MIN: SECONDS_IN_DAY,
+    SECONDS_IN_HOUR: SECONDS_IN_WEEK,
+}
+# how rolled up datapoints can be computed from the datapoints they cover
+AGGREGATIONS = ('mean', 'min', 'max', 'last', 'count')
+
+
+# numpy is only imported by the helpers working on arrays, so that the arithmetic on times
+# and resolutions can be used without it
 
 
 def time_stamp(t):
+    # pandas is only imported when Timestamps are asked for, it's slow to import
+    import pandas as pd
     if type(t) == int:
         epoch_time = t
         return pd.to_datetime(epoch_time, unit='s')
@@ -24,34 +36,13 @@ def time_stamp(t):
 
 
 def epoch(timestamp):
+    if isinstance(timestamp, numbers.Integral):
+        return int(timestamp)
     if isinstance(timestamp, str):
+        import pandas as pd
         timestamp = pd.Timestamp(timestamp)
-    return (timestamp - pd.Timestamp("1970-01-01")) // pd.Timedelta('1s')
-
-
-def list_tointerval(start_time, end_time, data_resolution, data):
-    if isinstance(start_time, int) or isinstance(start_time, str):
-        start_time = time_stamp(start_time)
-    if isinstance(end_time, int) or isinstance(end_time, str):
-        end_time = time_stamp(end_time)
-
-    dates = pd.date_range(
-                start_time,
-                end_time,
-                freq=pd.offsets.Second(data_resolution)
-            )[:-1]
-    dataframe = pd.DataFrame(data, index=dates, columns=['temperature'])
-    period = intervaltree.Interval(
-        time_stamp(start_time),
-        time_stamp(end_time),
-            cc.IntervalData(
-            data_resolution,
-            time_stamp(start_time),
-            time_stamp(end_time),
-            dataframe
-        ))
-
-    return period
+    # a pd.Timestamp
+    return timestamp.value // NANOSECONDS_IN_SECOND
 
 
 def resolution(duration):
@@ -82,60 +73,113 @@ def num_datapoints(duration, data_resolution=None):
     return int(duration / data_resolution)
 
 
-def rolledup_data(old_data, group_size):
-    return [
-        stats.mean(old_data[i:i + group_size])
-        for i in range(0, len(old_data), group_size)
-    ]
+def tile_keys(start_time, end_time, data_resolution):
+    '''(resolution, index) of the tiles at data_resolution covering [start_time, end_time), in
+    epoch time; tiles are aligned to multiples of their length since the epoch
+    '''
+    tile_seconds = TILE_SECONDS[data_resolution]
+    first = start_time // tile_seconds
+    last = -(-end_time // tile_seconds)
+    return [(data_resolution, index) for index in range(first, last)]
+
 
+def tile_range(key):
+    '''(start_time, end_time, resolution) of the tile with key (resolution, index)'''
+    data_resolution, index = key
+    tile_seconds = TILE_SECONDS[data_resolution]
+    return (index * tile_seconds, (index + 1) * tile_seconds, data_resolution)
 
-def extrapolated_data(old_data, factor):
-    return [v for sublist in [[v] * factor for v in old_data] for v in sublist]
 
+def to_array(data):
+    '''Float array of a list of datapoints, NaN for None'''
+    import numpy as np
+    return np.array(data, dtype=float)
 
-def scaled_data(old_data, old_resolution, new_resolution):
-    '''Given array of numbers, roll up or extrapolate data depending on the
-    ratio of old_resolution to new_resolution
+
+def to_list(values):
+    '''List of the datapoints in a float array, None for NaN'''
+    import numpy as np
+    datapoints = np.empty(len(values), dtype=object)
+    present = ~np.isnan(values)
+    datapoints[present] = values[present]
+    return datapoints.tolist()
+
+
+def rolledup_array(values, group_size, how='mean'):
+    '''Roll up every group_size consecutive datapoints of the float array values, NaN
+    meaning missing, with the aggregation how (see AGGREGATIONS); a partial group at the end
+    is rolled up on its own. Returns the rolled up datapoints, NaN for groups with no data,
+    and the fraction of the datapoints of each group that were there.
     '''
+    import numpy as np
+    if how not in AGGREGATIONS:
+        raise ValueError(f'Unknown aggregation {how}')
+    n_groups = -(-len(values) // group_size)
+    if len(values) == n_groups * group_size:
+        groups = values.reshape(n_groups, group_size)
+    else:
+        groups = np.full(n_groups * group_size, np.nan)
+        groups[:len(values)] = values
+        groups = groups.reshape(n_groups, group_size)
+    present = ~np.isnan(groups)
+    count = present.sum(axis=1)
+    sizes = np.full(n_groups, group_size)
+    if n_groups:
+        sizes[-1] = len(values) - (n_groups - 1) * group_size
+
+    if how == 'mean':
+        with np.errstate(invalid='ignore'):
+            rolled_up = np.where(present, groups, 0).sum(axis=1) / count
+    elif how == 'min':
+        # fmin and fmax skip NaN
+        rolled_up = np.fmin.reduce(groups, axis=1)
+    elif how == 'max':
+        rolled_up = np.fmax.reduce(groups, axis=1)
+    elif how == 'last':
+        last = group_size - 1 - present[:, ::-1].argmax(axis=1)
+        rolled_up = groups[np.arange(n_groups), last]
+    else:
+        rolled_up = count.astype(float)
+    return rolled_up, count / sizes
+
+
+def extrapolated_array(values, factor):
+    '''Repeat every datapoint of the float array values factor times. Returns the
+    datapoints, and whether each was there as the fraction 1 or 0.'''
+    import numpy as np
+    extrapolated = np.repeat(values, factor)
+    return extrapolated, (~np.isnan(extrapolated)).astype(float)
+
+
+def scaled_array(values, old_resolution, new_resolution, how='mean'):
+    '''scaled_data for a float array, NaN meaning missing, returning the fraction of the
+    datapoints behind every scaled one that were there as well (see rolledup_array)
+    '''
+    import numpy as np
     if old_resolution not in VALID_RESOLUTIONS or new_resolution not in VALID_RESOLUTIONS:
         raise ValueError('''Input resolution is not a correct resolution,
 this is likely a bug.''')
     if old_resolution == new_resolution:
-        return old_data
+        return values, (~np.isnan(values)).astype(float)
     elif old_resolution < new_resolution:
-        return rolledup_data(old_data, int(new_resolution / old_resolution))
+        return rolledup_array(values, new_resolution // old_resolution, how)
     else:
-        return extrapolated_data(old_data,
-                                 int(old_resolution / new_resolution))
+        return extrapolated_array(values, old_resolution // new_resolution)
 
 
-def period_data_splitter(iv, is_lower, point):
-    data = iv.data
-    if not data:
-        return None
-    if is_lower:
-        return cc.IntervalData(data.resolution, data.start_time, point,
-                          data.dataframe[:point][:-1])
-    else:
-        return cc.IntervalData(data.resolution, point, data.end_time,
-                          data.dataframe[point:])
+def rolledup_data(old_data, group_size, how='mean'):
+    return to_list(rolledup_array(to_array(old_data), group_size, how)[0])
 
 
-def period_data_reducer(data_earlier, data_later):
-    ''' Merge periods that are equal in start and end time,
-    and keep the higher resolution version
-    '''
-    if data_earlier.resolution <= data_later.resolution:
-        return data_earlier
-    else:
-        return data_later
+def extrapolated_data(old_data, factor):
+    return to_list(extrapolated_array(to_array(old_data), factor)[0])
 
 
-def period_data_combinator(data_earlier, data_later):
-    ''' Combine the data of two periods of the same resolution that are adjacent to each other
+def scaled_data(old_data, old_resolution, new_resolution, how='mean'):
+    '''Given array of numbers, roll up or extrapolate data depending on the
+    ratio of old_resolution to new_resolution. None is missing data.
     '''
-    assert data_earlier.resolution == data_later.resolution
+    if old_resolution == new_resolution and old_resolution in VALID_RESOLUTIONS:
+        return old_data
+    return to_list(scaled_array(to_array(old_data), old_resolution, new_resolution, how)[0])
 
-    return cc.IntervalData(
-        data_earlier.resolution, data_earlier.start_time, data_later.end_time,
-        pd.concat([data_earlier.dataframe, data_later.dataframe]))